@@ -42,6 +42,14 @@ DEFAULT_CREATING_DATASET_MODE = True
 DEFAULT_FOLDER_DIR = str(Path(os.getcwd())) + os.sep + 'debag' + os.sep
 DEFAULT_CORPUS = None
 DEFAULT_USE_OLD_UTTERANCE_CODE = False
+DEFAULT_BATCHED_STEP = False
+DEFAULT_FUSED_GAME_STEP = False
+DEFAULT_TRUNCATED_BPTT_STEPS = 0
+DEFAULT_CHECKPOINT_TIMESTEPS = False
+DEFAULT_COMPILE_STEP = False
+DEFAULT_COMPILE_CACHE_DIR = str(Path(os.getcwd())) + os.sep + '.compile_cache' + os.sep
+DEFAULT_TRAJECTORY_QUEUE_SIZE = 16
+DEFAULT_DROP_TRAJECTORIES = False
 
 
 DEFAULT_INIT_RANGE = 0.1
@@ -54,6 +62,12 @@ DEFAULT_MOMENTUM = 0.1
 DEFAULT_NESTEROV = False
 DEFAULT_CLIP = 0.5
 DEFAULT_TEMPERATURE = 0.5
+DEFAULT_LM_CHECKPOINT_INTERVAL = 100
+DEFAULT_LM_CHECKPOINT_FILE = 'lm_model.pt'
+DEFAULT_LM_BEST_CHECKPOINT_FILE = 'lm_model_best.pt'
+DEFAULT_UTTERANCE_LOG_EVERY = 1
+DEFAULT_LM_BATCH_SIZE = 256
+DEFAULT_LM_VALID_INTERVAL = 200
 
 UtteranceConfig = NamedTuple('UtteranceConfig', [
     ('folder_dir', str),
@@ -69,6 +83,10 @@ UtteranceConfig = NamedTuple('UtteranceConfig', [
     ('batch_size', int),
     ('temperature', float),
     ('fb_dir', str),
+    ('lm_checkpoint_interval', int),
+    ('log_every', int),
+    ('lm_batch_size', int),
+    ('lm_valid_interval', int),
 ])
 
 
@@ -97,7 +115,10 @@ GameConfig = NamedTuple('GameConfig', [
     ('memory_size', int),
     ('use_cuda', bool),
     ('time_horizon', int),
-    ('num_epochs', int)
+    ('num_epochs', int),
+    ('fused_step', bool),
+    ('trajectory_queue_size', int),
+    ('drop_trajectories', bool)
 ])
 
 ProcessingModuleConfig = NamedTuple('ProcessingModuleConfig', [
@@ -145,7 +166,12 @@ AgentModuleConfig = NamedTuple("AgentModuleConfig", [
     ('use_utterances', bool),
     ('penalize_words', bool),
     ('use_cuda', bool),
-    ('df_utterance_col_name', list)
+    ('df_utterance_col_name', list),
+    ('batched_step', bool),
+    ('truncated_bptt_steps', int),
+    ('checkpoint_timesteps', bool),
+    ('compile_step', bool),
+    ('compile_cache_dir', str)
     ])
 
 RunModuleConfig = NamedTuple("RunModuleConfig", [
@@ -187,7 +213,10 @@ default_game_config = GameConfig(
     DEFAULT_HIDDEN_SIZE,
     False,
     DEFAULT_TIME_HORIZON,
-    DEFAULT_NUM_EPOCHS,)
+    DEFAULT_NUM_EPOCHS,
+    DEFAULT_FUSED_GAME_STEP,
+    DEFAULT_TRAJECTORY_QUEUE_SIZE,
+    DEFAULT_DROP_TRAJECTORIES,)
 
 default_run_config = RunModuleConfig(
     save_to_a_new_dir=DEFAULT_SAVE_TO_A_NEW_DIR,
@@ -243,7 +272,12 @@ default_agent_config = AgentModuleConfig(
         use_utterances=USE_UTTERANCES,
         penalize_words=PENALIZE_WORDS,
         use_cuda=False,
-        df_utterance_col_name = DEFAULT_DF_UTTERANCE_COL_NAME)
+        df_utterance_col_name = DEFAULT_DF_UTTERANCE_COL_NAME,
+        batched_step=DEFAULT_BATCHED_STEP,
+        truncated_bptt_steps=DEFAULT_TRUNCATED_BPTT_STEPS,
+        checkpoint_timesteps=DEFAULT_CHECKPOINT_TIMESTEPS,
+        compile_step=DEFAULT_COMPILE_STEP,
+        compile_cache_dir=DEFAULT_COMPILE_CACHE_DIR)
 
 default_utterance_config = UtteranceConfig(
         folder_dir=DEFAULT_FOLDER_DIR,
@@ -258,10 +292,15 @@ default_utterance_config = UtteranceConfig(
         clip=DEFAULT_CLIP,
         batch_size=default_game_config.batch_size,
         temperature=DEFAULT_TEMPERATURE,
-        fb_dir=DEFAULT_FB_DIR)
+        fb_dir=DEFAULT_FB_DIR,
+        lm_checkpoint_interval=DEFAULT_LM_CHECKPOINT_INTERVAL,
+        log_every=DEFAULT_UTTERANCE_LOG_EVERY,
+        lm_batch_size=DEFAULT_LM_BATCH_SIZE,
+        lm_valid_interval=DEFAULT_LM_VALID_INTERVAL)
 
 
-def get_utterance_config():
+def get_utterance_config(kwargs=None):
+    kwargs = kwargs or {}
     return UtteranceConfig(
         folder_dir=default_utterance_config.folder_dir,
         init_range=default_utterance_config.init_range,
@@ -275,7 +314,11 @@ def get_utterance_config():
         clip=default_utterance_config.clip,
         batch_size=default_game_config.batch_size,
         temperature=default_utterance_config.temperature,
-        fb_dir=default_utterance_config.fb_dir)
+        fb_dir=default_utterance_config.fb_dir,
+        lm_checkpoint_interval=kwargs.get('lm_checkpoint_interval') or default_utterance_config.lm_checkpoint_interval,
+        log_every=kwargs.get('utterance_log_every') or default_utterance_config.log_every,
+        lm_batch_size=kwargs.get('lm_batch_size') or default_utterance_config.lm_batch_size,
+        lm_valid_interval=kwargs.get('lm_valid_interval') or default_utterance_config.lm_valid_interval)
         #todo we should use below data so we can change it using parmaters
         # init_range=kwargs['init_range'] or default_utterance_config.init_range,
         # nhid_lang=kwargs['nhid_lang'] or default_utterance_config.nhid_lang,
@@ -318,6 +361,9 @@ def get_game_config(kwargs):
         use_cuda=kwargs['use_cuda'],
         time_horizon=kwargs['n_timesteps'] or default_game_config.time_horizon,
         num_epochs=kwargs['n_epochs'] or default_game_config.num_epochs,
+        fused_step=kwargs['fused_game_step'] or default_game_config.fused_step,
+        trajectory_queue_size=kwargs['trajectory_queue_size'] or default_game_config.trajectory_queue_size,
+        drop_trajectories=kwargs['drop_trajectories'] or default_game_config.drop_trajectories,
     )
 
 
@@ -365,7 +411,12 @@ def get_agent_config(kwargs):
             use_utterances=use_utterances,
             penalize_words=penalize_words,
             use_cuda=use_cuda,
-            df_utterance_col_name=default_agent_config.df_utterance_col_name
+            df_utterance_col_name=default_agent_config.df_utterance_col_name,
+            batched_step=kwargs['batched_step'] or default_agent_config.batched_step,
+            truncated_bptt_steps=kwargs['truncated_bptt_steps'] or default_agent_config.truncated_bptt_steps,
+            checkpoint_timesteps=kwargs['checkpoint_timesteps'] or default_agent_config.checkpoint_timesteps,
+            compile_step=kwargs['compile_agent_step'] or default_agent_config.compile_step,
+            compile_cache_dir=kwargs['compile_cache_dir'] or default_agent_config.compile_cache_dir
             )
 
 
@@ -1,4 +1,16 @@
 #creat data set
+import argparse
+import os
+
+from modules.template_compiler import TemplateCompiler, vocabulary
+
+import configs
+
+parser = argparse.ArgumentParser(description="Writes the sentences of the text templates to train/val/test dataset files")
+parser.add_argument('--num-colors', '-c', type=int, help='if specified sets number of colors the templates are filled with (default 3)')
+parser.add_argument('--num-shapes', '-s', type=int, help='if specified sets number of shapes the templates are filled with (default 2)')
+parser.add_argument('--dataset-dir', type=str, help='directory the dataset files are written to (default data)')
+
 vocab = ['go', 'to', 'agent', 'red', 'green', 'blue', 'landmark',
              'circle', 'triangle', 'continue', 'next', 'ahead', 'done',
              'good', 'stay', 'goal']
@@ -19,7 +31,7 @@ sentence_form = ["<color1> agent go to <color2> landmark",
                  "<shape1> agent continue",
                  "<color1> agent is done",
                  "<color1> <shape1> agent is done",
-                 "<shape1> agent is done"
+                 "<shape1> agent is done",
                  "<color1> good job",
                  "<color1> <shape1> good job",
                  "<shape1> good job",
@@ -27,15 +39,22 @@ sentence_form = ["<color1> agent go to <color2> landmark",
 
 
 
-def create_dataset(res):
-    for shape1 in shapes:
-        for color1 in colors:
-            for shape2 in shapes:
-                for color2 in colors:
-                    tmp = sentence_form.copy()
-                    tmp = [t.replace("<color1>", color1).replace("<shape1>", shape1).replace("<color2>", color2).replace("<shape2>", shape2) for t in tmp]
-                    res+=tmp
-    print(list(set(res)))
+VALID_FRACTION = 0.1
+TEST_FRACTION = 0.1
+
+
+def create_dataset():
+    args = vars(parser.parse_args())
+    vocabularies = {'color': vocabulary(colors, args['num_colors'] or configs.NUM_COLORS, 'color'),
+                    'shape': vocabulary(shapes, args['num_shapes'] or configs.NUM_SHAPES, 'shape')}
+    dataset_dir = args['dataset_dir'] or 'data'
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+    compiler = TemplateCompiler(sentence_form, vocabularies)
+    counts = compiler.write_splits(dataset_dir, 'sentences', VALID_FRACTION, TEST_FRACTION)
+    print("Wrote %d distinct sentences of %d filled templates to %s [train %d][val %d][test %d]" % (
+        sum(counts), compiler.size(), dataset_dir, counts[0], counts[1], counts[2]))
 
 
-create_dataset([])
\ No newline at end of file
+if __name__ == "__main__":
+    create_dataset()
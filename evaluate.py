@@ -0,0 +1,60 @@
+import math
+import time
+
+import numpy as np
+import torch
+from modules.agent import AgentModule
+from modules.game import GameModule
+from modules.rollout import RolloutEngine
+from modules.scripted_policy import ScriptedPolicy
+
+import configs
+import constants
+from train import parser
+
+
+def main():
+    args = vars(parser.parse_args())
+    run_config = configs.get_run_config(args)
+    agent_config = configs.get_agent_config(args)
+    game_config = configs.get_game_config(args)
+    training_config = configs.get_training_config(args, run_config.folder_dir)
+    utterance_config = configs.get_utterance_config(args)
+    if not args['scripted_policy'] and game_config.use_utterances and not run_config.create_utterance_using_old_code:
+        # the Utterance language model decodes one agent's sentences at a time, not in the batched rollouts
+        parser.error('evaluate.py needs the batched agent step, which the Utterance language model does not '
+                     'support: pass --no-utterances, --create-utterance-using-old-code True or --scripted-policy')
+    if args['scripted_policy']:
+        engine = ScriptedPolicy(game_config.time_horizon, constants.MOVEMENT_STEP_SIZE)
+        game_config = ScriptedPolicy.game_config(game_config)
+    else:
+        agent = AgentModule(agent_config, utterance_config, run_config.corpus, False,
+                            run_config.create_utterance_using_old_code)
+        if training_config.load_model:
+            agent.load_state_dict(torch.load(training_config.load_model_file))
+            print("Loaded agent model weights from %s" % training_config.load_model_file)
+        if training_config.use_cuda:
+            agent.cuda()
+        engine = RolloutEngine(agent)
+
+    num_batches = int(math.ceil((args['eval_games'] or game_config.batch_size) / float(game_config.batch_size)))
+    total_cost, total_dist, total_agents = 0.0, 0.0, 0
+    start = time.time()
+    for batch in range(num_batches):
+        num_agents = np.random.randint(game_config.min_agents, game_config.max_agents + 1)
+        num_landmarks = np.random.randint(game_config.min_landmarks, game_config.max_landmarks + 1)
+        game = GameModule(game_config, num_agents, num_landmarks, run_config.folder_dir)
+        if training_config.use_cuda:
+            game.cuda()
+        trajectory = engine.run(game)
+        total_cost += trajectory['costs'].sum().item()
+        total_dist += trajectory['goal_distances'][-1].sum().item()
+        total_agents += game.agent_counts.sum().item()
+
+    num_games = num_batches * game_config.batch_size
+    print("[%d games][avg loss per agent: %f][avg final dist: %f][%.0f games/sec]" % (
+        num_games, total_cost / total_agents, total_dist / total_agents, num_games / (time.time() - start)))
+
+
+if __name__ == "__main__":
+    main()
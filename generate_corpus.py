@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import random
+
+import numpy as np
+import torch
+from modules.game import GameModule
+from modules.predefined_utterances_module import SentenceTable
+from modules.scripted_policy import ScriptedPolicy
+
+import configs
+import constants
+from train import parser
+
+"""
+    Generates the dialogue corpus (dataset_train.txt, dataset_val.txt and
+    dataset_test.txt) without the network: the games are simulated in batches
+    (shards) by worker processes, each shard seeded with --dataset-seed plus its
+    index, the agents are moved by the ScriptedPolicy and their sentences are
+    picked from the predefined templates by their distance to the goal at every
+    timestep. Every line has the form
+        <input> agent_color agent_shape lm_color lm_shape (per agent) </input>
+        <dialogue> the sentences of every timestep, agent by agent </dialogue>
+        <output> the final distance of every agent to its goal </output>
+    The workers return whole shards of lines, which are written in shard order
+    with one buffered write per file.
+"""
+
+DATASET_NUM_AGENTS = 2
+VALID_FRACTION = 0.1
+TEST_FRACTION = 0.1
+SPLIT_FILES = ['dataset_train.txt', 'dataset_val.txt', 'dataset_test.txt']
+
+
+def generate_shard(shard):
+    """The lines of one batch of games, split into train, valid and test."""
+    game_config, seed, folder_dir = shard
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    table = SentenceTable()
+    num_landmarks = np.random.randint(game_config.min_landmarks, game_config.max_landmarks + 1)
+    game = GameModule(game_config, DATASET_NUM_AGENTS, num_landmarks, folder_dir)
+    policy = ScriptedPolicy(game.time_horizon, constants.MOVEMENT_STEP_SIZE)
+    fillings = torch.cat((game.colors[:, :game.num_agents], game.shapes[:, :game.num_agents],
+                          game.colors.gather(1, game.goal_entities), game.shapes.gather(1, game.goal_entities)),
+                         2).long().numpy()
+    dialogue = np.empty((game.batch_size, game.time_horizon, game.num_agents), dtype=object)
+    with torch.no_grad():
+        for t in range(game.time_horizon):
+            game.step(policy.movements(game), None, None)
+            dist = np.around(game.get_avg_agent_to_goal_distance()[1].numpy(), 2)
+            for agent in range(game.num_agents):
+                groups = table.groups(dist[:, agent], t)
+                dialogue[:, t, agent] = table.decode(table.ids(groups, fillings[:, agent]))
+
+    splits = [[], [], []]
+    split_keys = np.random.rand(game.batch_size)
+    split_of = np.where(split_keys < VALID_FRACTION, 1, np.where(split_keys < VALID_FRACTION + TEST_FRACTION, 2, 0))
+    for b in range(game.batch_size):
+        splits[split_of[b]].append('<input> %s </input> <dialogue> %s </dialogue> <output> %s </output>\n' % (
+            ' '.join(map(str, fillings[b].reshape(-1))), ' '.join(dialogue[b].reshape(-1)),
+            ' '.join(map(str, dist[b]))))
+    return [''.join(lines) for lines in splits]
+
+
+def init_worker():
+    torch.set_num_threads(1)
+
+
+def main():
+    args = vars(parser.parse_args())
+    game_config = ScriptedPolicy.game_config(configs.get_game_config(args))._replace(use_cuda=False, fused_step=False)
+    num_dialogues = args['num_dialogues'] or game_config.batch_size
+    dataset_dir = args['dataset_dir'] or 'data'
+    seed = args['dataset_seed'] or 0
+    num_shards = (num_dialogues + game_config.batch_size - 1) // game_config.batch_size
+    shards = [(game_config, seed + shard, dataset_dir) for shard in range(num_shards)]
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    files = [open(os.path.join(dataset_dir, file_name), 'w', buffering=1 << 20) for file_name in SPLIT_FILES]
+    pool = multiprocessing.Pool(args['num_workers'] or os.cpu_count(), init_worker)
+    try:
+        for shard, texts in enumerate(pool.imap(generate_shard, shards)):
+            for f, text in zip(files, texts):
+                f.write(text)
+            if (shard + 1) % 100 == 0:
+                print("[%d/%d shards]" % (shard + 1, num_shards))
+    finally:
+        pool.close()
+        pool.join()
+        for f in files:
+            f.close()
+    print("Wrote %d dialogues to %s" % (num_shards * game_config.batch_size, dataset_dir))
+
+
+if __name__ == "__main__":
+    main()
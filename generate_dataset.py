@@ -1,5 +1,7 @@
 import random
 
+from modules.template_compiler import Template
+
 vocab = ['go', 'to', 'agent', 'red', 'green', 'blue', 'landmark', 'circle',
          'triangle', 'continue', 'next', 'ahead', 'done', 'good', 'stay',
          'goal']
@@ -26,7 +28,7 @@ stay_sentences=[
 done_sentences=[
     "<agent_color> agent is done",
     "<agent_color> <agent_shape> agent is done",
-    "<agent_shape> agent is done"
+    "<agent_shape> agent is done",
     "<agent_color> good job",
     "<agent_color> <agent_shape> good job",
     "<agent_shape> good job",
@@ -34,16 +36,12 @@ done_sentences=[
 ]
 
 sentence_form = goto_sentences + continue_sentences+stay_sentences+done_sentences
+templates = [Template(sentence) for sentence in sentence_form]
 
 
-@staticmethod
 def generate_sentence(agent_color, agent_shape, lm_color, lm_shape):
-    sentence = random.choice(sentence_form)
-    sentence.replace('<agent_color>', agent_color)
-    sentence.replace('<agent_shape>', agent_shape)
-    sentence.replace('<lm_color>', lm_color)
-    sentence.replace('<lm_shape>', lm_shape)
-    return sentence
+    return random.choice(templates).fill({'agent_color': agent_color, 'agent_shape': agent_shape,
+                                          'lm_color': lm_color, 'lm_shape': lm_shape})
 
 # agent_num = 2
 # lm_num = random.randint(2,3)
@@ -46,7 +46,7 @@ class ActionModule(nn.Module):
                 [physical.squeeze(1), utterance_feat.squeeze(1), goal_processed],
                 1).squeeze(1)
         else:
-            x = torch.cat([physical.squeeze(0), goal_processed], 1).squeeze(1)
+            x = torch.cat([physical.squeeze(1), goal_processed], 1).squeeze(1)
         processed, mem = self.processor(x, mem)
         return processed, mem
 
@@ -5,10 +5,12 @@ import torch.nn as nn
 
 from modules.predefined_utterances_module import PredefinedUtterancesModule
 from modules.action import ActionModule
+from modules.compiled import compile_method, enable_compile_cache
 from modules.goal_predicting import GoalPredictingProcessingModule
 from modules.processing import ProcessingModule
 from modules.word_counting import WordCountingModule
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 import pandas as pd
 import numpy as np
 
@@ -16,7 +18,9 @@ import numpy as np
     The AgentModule is the general module that's responsible for the execution of
     the overall policy throughout training. It holds all information pertaining to
     the whole training episode, and at each forward pass runs a given game until
-    the end, returning the total cost all agents collected over the entire game
+    the end, returning the total cost all agents collected over the entire game.
+    With truncated_bptt_steps the cost is backpropagated inside forward every k
+    timesteps, and the returned total cost is detached.
 """
 class AgentModule(nn.Module):
     def __init__(self, config, utterance_config, corpus, dataset_mode, use_old_utterance_code):
@@ -36,6 +40,17 @@ class AgentModule(nn.Module):
                 self.word_counter = WordCountingModule(config.word_counter)
         if self.create_data_set_mode:
             self.create_data_set = PredefinedUtterancesModule()
+        if config.compile_step:
+            self.compile_step(config.compile_cache_dir)
+
+    def compile_step(self, cache_dir):
+        # the GRUCell + dropout + Linear + ELU stacks dominate the per-timestep python overhead
+        enable_compile_cache(cache_dir)
+        compile_method(self.physical_processor)
+        if self.using_utterances:
+            compile_method(self.utterance_processor)
+        compile_method(self.action_processor, 'processed_data')
+        compile_method(self.action_processor.movement_chooser)
 
     def init_from_config(self, config):
         self.training = True
@@ -50,6 +65,9 @@ class AgentModule(nn.Module):
         self.Tensor = torch.cuda.FloatTensor if self.using_cuda else torch.FloatTensor
         self.df_utterance_col_name = config.df_utterance_col_name
         self.mode = config.action_processor.mode
+        self.batched_step = config.batched_step
+        self.truncated_bptt_steps = config.truncated_bptt_steps
+        self.checkpoint_timesteps = config.checkpoint_timesteps
 
     def reset(self):
         self.total_cost = torch.zeros_like(self.total_cost)
@@ -60,14 +78,16 @@ class AgentModule(nn.Module):
         super(AgentModule, self).train(mode)
         self.training = mode
 
+    def detach_state(self, game):
+        game.detach_state()
+        if self.using_utterances and self.penalizing_words:
+            self.word_counter.word_counts = self.word_counter.word_counts.detach()
+
     def update_mem(self, game, mem_str, new_mem, agent, other_agent=None):
-        # TODO: Look into tensor copying from Variable
-        new_big_mem = Variable(self.Tensor(game.memories[mem_str].data))
         if other_agent is not None:
-            new_big_mem[:, agent, other_agent] = new_mem
+            game.memories.write(mem_str, new_mem, agent, other_agent)
         else:
-            new_big_mem[:, agent] = new_mem
-        game.memories[mem_str] = new_big_mem
+            game.memories.write(mem_str, new_mem, agent)
 
     def process_utterances(self, game, agent, other_agent, utterance_processes, goal_predictions):
         utterance_processed, new_mem, goal_predicted = self.utterance_processor(game.utterances[:,other_agent], game.memories["utterance"][:, agent, other_agent])
@@ -75,23 +95,25 @@ class AgentModule(nn.Module):
         utterance_processes[:, other_agent, :] = utterance_processed
         goal_predictions[:, agent, other_agent, :] = goal_predicted
 
-    def process_physical(self, game, agent, other_entity, physical_processes):
-        physical_processed, new_mem = self.physical_processor(torch.cat((game.observations[:,agent,other_entity],game.physical[:,other_entity]), 1), game.memories["physical"][:,agent, other_entity])
-        self.update_mem(game, "physical", new_mem,agent, other_entity)
-        physical_processes[:,other_entity,:] = physical_processed
+    def process_physical(self, game, agent):
+        # fold the entity axis into the batch so the shared processor runs once over [batch*entities]
+        physical_input = torch.cat((game.observations[:, agent], game.physical), 2)
+        physical_processed, new_mem = self.physical_processor(
+            physical_input.view(game.batch_size * game.num_entities, -1),
+            game.memories["physical"][:, agent].contiguous().view(game.batch_size * game.num_entities, -1))
+        self.update_mem(game, "physical", new_mem.view(game.batch_size, game.num_entities, -1), agent)
+        return physical_processed.view(game.batch_size, game.num_entities, self.processing_hidden_size)
 
     def get_physical_feat(self, game, agent):
-        physical_processes = Variable(self.Tensor(game.batch_size, game.num_entities, self.processing_hidden_size))
-        for entity in range(game.num_entities):
-            self.process_physical(game, agent, entity, physical_processes)
-        return self.physical_pooling(physical_processes)
+        physical_processes = self.process_physical(game, agent)
+        return self.pool(self.physical_pooling, physical_processes, game, game.entity_mask)
 
     def get_utterance_feat(self, game, agent, goal_predictions):
         if self.using_utterances:
             utterance_processes = Variable(self.Tensor(game.batch_size, game.num_agents, self.processing_hidden_size))
             for other_agent in range(game.num_agents):
                 self.process_utterances(game, agent, other_agent, utterance_processes, goal_predictions)
-            return self.utterance_pooling(utterance_processes)
+            return self.pool(self.utterance_pooling, utterance_processes, game, game.agent_mask)
         else:
             return None
 
@@ -107,6 +129,81 @@ class AgentModule(nn.Module):
             utterances[:,agent,:] = utterance
             # utterances_super[:,agent,:] = utter_super #todo see if we need this
 
+    def pool(self, pooling, processes, game, mask):
+        # padded entities of mixed-size batches must never win the max pooling
+        if game.padded:
+            processes = processes.masked_fill(~mask.unsqueeze(2), float('-inf'))
+        return pooling(processes)
+
+    def can_batch_step(self):
+        # the pretrained Utterance module decodes one agent's batch of sentences at a time
+        return (self.batched_step or self.checkpoint_timesteps) and \
+               (not self.using_utterances or self.use_old_utterance_code)
+
+    def truncating_bptt(self):
+        return self.truncated_bptt_steps > 0 and self.training
+
+    def fold_agents(self, x):
+        # agent-major folding keeps the row order of the per-agent loop (and of its gumbel noise)
+        return x.transpose(0, 1).contiguous().view(-1, *x.size()[2:])
+
+    def unfold_agents(self, x, game):
+        return x.view(game.num_agents, game.batch_size, *x.size()[1:]).transpose(0, 1)
+
+    def compute_step(self, game, observations, physical, utterances, observed_goals,
+                     physical_mem, utterance_mem, action_mem):
+        """Computes the physical, utterance and action processing of all agents for one timestep in a few
+        large calls over [agents*batch*entities] and [agents*batch]. It only reads the game's sizes and
+        masks, so it can be recomputed during backward when checkpointing timesteps."""
+        batch_agents = game.num_agents * game.batch_size
+        physical_input = torch.cat(
+            (observations, physical.unsqueeze(1).expand(-1, game.num_agents, -1, -1)), 3)
+        physical_processed, physical_mem = self.physical_processor(
+            self.fold_agents(physical_input).view(batch_agents * game.num_entities, -1),
+            self.fold_agents(physical_mem).view(batch_agents * game.num_entities, -1))
+        physical_mem = self.unfold_agents(physical_mem.view(batch_agents, game.num_entities, -1), game)
+        physical_feat = self.pool(self.physical_pooling, physical_processed.view(batch_agents, game.num_entities, -1),
+                                  game, self.fold_agents(game.entity_mask.unsqueeze(1).expand(-1, game.num_agents, -1)))
+
+        utterance_feat = None
+        goal_predictions = None
+        if self.using_utterances:
+            utterance_input = utterances.unsqueeze(1).expand(-1, game.num_agents, -1, -1)
+            utterance_processed, utterance_mem, goal_predicted = self.utterance_processor(
+                self.fold_agents(utterance_input).view(batch_agents * game.num_agents, -1),
+                self.fold_agents(utterance_mem).view(batch_agents * game.num_agents, -1))
+            utterance_mem = self.unfold_agents(utterance_mem.view(batch_agents, game.num_agents, -1), game)
+            goal_predictions = self.unfold_agents(goal_predicted.view(batch_agents, game.num_agents, -1), game)
+            utterance_feat = self.pool(self.utterance_pooling, utterance_processed.view(batch_agents, game.num_agents, -1),
+                                       game, self.fold_agents(game.agent_mask.unsqueeze(1).expand(-1, game.num_agents, -1)))
+
+        movement, utterance, action_mem, _, _ = self.action_processor(
+            physical_feat, self.fold_agents(observed_goals), self.fold_agents(action_mem),
+            self.training, True, None, 0, utterance_feat)
+        movement = self.unfold_agents(movement, game)
+        action_mem = self.unfold_agents(action_mem, game)
+        utterance = self.unfold_agents(utterance, game) if self.using_utterances else None
+        return movement, utterance, goal_predictions, physical_mem, utterance_mem, action_mem
+
+    def step_batched(self, game, movements):
+        """Runs one batched timestep for all agents and writes the new memories to the game."""
+        inputs = (game.observations, game.physical, game.utterances if self.using_utterances else None,
+                  game.observed_goals, game.memories["physical"],
+                  game.memories["utterance"] if self.using_utterances else None, game.memories["action"])
+        if self.checkpoint_timesteps and self.training:
+            # keep only the step inputs and recompute the step's activations during backward
+            outputs = checkpoint(lambda *step_inputs: self.compute_step(game, *step_inputs), *inputs,
+                                 use_reentrant=False)
+        else:
+            outputs = self.compute_step(game, *inputs)
+        movement, utterances, goal_predictions, physical_mem, utterance_mem, action_mem = outputs
+        game.memories.write("physical", physical_mem)
+        if self.using_utterances:
+            game.memories.write("utterance", utterance_mem)
+        game.memories.write("action", action_mem)
+        movements[:, :game.num_agents] = movement
+        return movements, utterances, goal_predictions
+
     def forward(self, game):
         timesteps = []
         if self.create_data_set_mode:
@@ -115,11 +212,13 @@ class AgentModule(nn.Module):
         self.total_loss = 0
         self.words_loss = 0
         self.emergamce_loss = 0
+        truncated_cost = 0
         for t in range(self.time_horizon):
             movements = Variable(self.Tensor(game.batch_size, game.num_entities, self.movement_dim_size).zero_())
             utterances = None
+            utterances_super = None
             goal_predictions = None
-            if self.using_utterances:
+            if self.using_utterances and not self.can_batch_step():
                 utterances = Variable(self.Tensor(game.batch_size, game.num_agents, self.vocab_size))
                 utterances_super = Variable(self.Tensor(game.batch_size, game.num_agents, self.vocab_size))
                 goal_predictions = Variable(self.Tensor(game.batch_size, game.num_agents, game.num_agents, self.goal_size))
@@ -127,20 +226,35 @@ class AgentModule(nn.Module):
             if self.create_data_set_mode:
                 self.df_utterance = self.create_data_set.generate_sentences(game, t, self.df_utterance, mode=self.mode)
 
-            for agent in range(game.num_agents):
-                physical_feat = self.get_physical_feat(game, agent)
-                utterance_feat = self.get_utterance_feat(game, agent, goal_predictions)
-                if self.create_data_set_mode:
-                    self.get_action(game, agent, physical_feat, utterance_feat, movements, utterances,
-                                    self.df_utterance[agent]['Full Sentence' + str(t)], utterances_super)
-                else:
-                    self.get_action(game, agent, physical_feat, utterance_feat, movements, utterances)
+            if self.can_batch_step():
+                movements, utterances, goal_predictions = self.step_batched(game, movements)
+            else:
+                for agent in range(game.num_agents):
+                    physical_feat = self.get_physical_feat(game, agent)
+                    utterance_feat = self.get_utterance_feat(game, agent, goal_predictions)
+                    if self.create_data_set_mode:
+                        self.get_action(game, agent, physical_feat, utterance_feat, movements, utterances,
+                                        self.df_utterance[agent]['Full Sentence' + str(t)], utterances_super)
+                    else:
+                        self.get_action(game, agent, physical_feat, utterance_feat, movements, utterances)
+            game.memories.commit()
 
             cost = game(movements, goal_predictions, utterances, t, utterances_super)
             if self.penalizing_words:
+                if game.padded:
+                    utterances = utterances.masked_fill(~game.agent_mask.unsqueeze(2), 0)
                 cost = cost + self.word_counter(utterances)
             self.total_loss =  0 #todo change
-            self.total_cost = self.total_cost + cost + self.total_loss
+            if self.truncating_bptt():
+                # backpropagate every truncated_bptt_steps timesteps and carry on from detached state
+                truncated_cost = truncated_cost + cost + self.total_loss
+                if (t + 1) % self.truncated_bptt_steps == 0 or t + 1 == self.time_horizon:
+                    truncated_cost.backward()
+                    self.total_cost = self.total_cost + truncated_cost.detach()
+                    truncated_cost = 0
+                    self.detach_state(game)
+            else:
+                self.total_cost = self.total_cost + cost + self.total_loss
             if not self.training:
                 timesteps.append({
                     'locations': game.locations,
@@ -150,5 +264,6 @@ class AgentModule(nn.Module):
                     timesteps[-1]['utterances'] = utterances
 
         if self.create_data_set_mode:
-            self.create_data_set.generate_dataset_txt_file(game.batch_size, self.df_utterance, self.df_utterance_col_name)
+            self.create_data_set.generate_dataset_txt_file(game.batch_size, self.df_utterance, self.df_utterance_col_name,
+                                                           game.agent_counts.cpu().numpy())
         return self.total_cost, timesteps
@@ -0,0 +1,90 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+import torch
+
+"""
+    A CheckpointManager saves a model's state dict every `interval` steps to `path`.
+    The losses given to step() are averaged over each interval, and when the mean
+    improves on the best one seen so far the interval's snapshot also goes to
+    `best_path`; best() does the same for a snapshot with a validation loss.
+    The state dict is copied to CPU memory on the training thread, and the copy is
+    written by a background thread into a temporary file that is then renamed over
+    the checkpoint, so a checkpoint on disk is always complete and training never
+    waits for the disk. If the writer falls behind, only the newest pending
+    snapshot of each path is written. close() waits for the pending writes.
+"""
+class CheckpointManager(object):
+    def __init__(self, path, interval, best_path=None):
+        self.path = path
+        self.interval = interval
+        self.best_path = best_path
+        self.best_loss = float('inf')
+        self.loss_sum = 0.0
+        self.loss_count = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+        atexit.register(self.close)
+
+    def step(self, model, step, loss=None, force=False):
+        """Snapshots the model if step is on the interval (or force is set), and keeps the snapshot
+        as the best one if the mean loss since the last snapshot is the best so far."""
+        if loss is not None:
+            self.loss_sum += loss
+            self.loss_count += 1
+        if not (force or (self.interval > 0 and step % self.interval == 0)):
+            return
+        snapshot = self.snapshot(model)
+        self.save(snapshot, self.path)
+        if self.loss_count:
+            self.best(snapshot, self.loss_sum / self.loss_count)
+            self.loss_sum = 0.0
+            self.loss_count = 0
+
+    def snapshot(self, model):
+        """A CPU copy of the model's state dict."""
+        return {name: value.detach().cpu().clone() for name, value in model.state_dict().items()}
+
+    def best(self, snapshot, loss):
+        """Keeps an earlier snapshot if its (e.g. asynchronously computed) loss is the best so far."""
+        if self.best_path is not None and loss < self.best_loss:
+            self.best_loss = loss
+            self.save(snapshot, self.best_path)
+
+    def save(self, snapshot, path):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write_loop)
+            self.thread.daemon = True
+            self.thread.start()
+        with self.lock:
+            newer_pending = path in self.pending
+            self.pending[path] = snapshot
+        if not newer_pending:
+            self.queue.put(path)
+
+    def write_loop(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            with self.lock:
+                snapshot = self.pending.pop(path)
+            tmp_path = path + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    torch.save(snapshot, f)
+                os.replace(tmp_path, path)
+            except (IOError, OSError) as e:
+                logging.warning('writing checkpoint %s failed: %s', path, e)
+
+    def close(self):
+        """Writes the pending snapshots and stops the writer thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,55 @@
+import logging
+import os
+
+import torch
+
+"""
+    Optional compiled execution for the small per-timestep computations of the agent.
+    compile_method swaps a module's method for a CompiledFunction that compiles it
+    with torch.compile on first use (its inductor graph cache is kept on disk under
+    the directory given to enable_compile_cache, so later runs reuse the compiled
+    kernels instead of recompiling at startup). Parameters stay owned by the original
+    module, so state dicts are unchanged. torch.compile compiles on the first call: if
+    that call fails, or torch has no torch.compile, the method runs in eager mode for
+    the rest of the run. Errors of later calls are raised as they are.
+"""
+
+
+def enable_compile_cache(cache_dir):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+def compile_method(module, method='forward'):
+    setattr(module, method, CompiledFunction(getattr(module, method), module, method))
+
+
+class CompiledFunction(object):
+    def __init__(self, eager, module, method):
+        self.eager = eager
+        self.module = module
+        self.method = method
+        self.compiled = None
+        self.failed = False
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            return self.compiled(*args)
+        if self.failed or not hasattr(torch, 'compile'):
+            return self.eager(*args)
+        try:
+            compiled = torch.compile(self.eager)
+            result = compiled(*args)
+        except Exception as e:
+            logging.warning('compiling %s.%s failed, falling back to eager mode: %s',
+                            type(self.module).__name__, self.method, e)
+            self.failed = True
+            return self.eager(*args)
+        self.compiled = compiled
+        return result
@@ -7,8 +7,13 @@
 A library that is responsible for data reading.
 """
 
+import array
+import hashlib
 import os
+import queue
 import random
+import shutil
+import threading
 import sys
 import pdb
 import copy
@@ -26,6 +31,20 @@ SPECIAL = [
     '<pad>',
 ]
 
+# the tokenized corpora are cached in this directory of the dataset folder
+CORPUS_CACHE_DIR = '.corpus_cache'
+# bump when the cached format changes
+CORPUS_CACHE_VERSION = 1
+# index of the input and output tokens missing from their dictionaries, which have no <unk>.
+# These ids are never looked up in an embedding: DialogueContexts gives the inputs holding them
+# a zero context, and a consumer that embeds them (e.g. the context encoders of modules_for_lm)
+# has to map UNKNOWN_IDX first.
+UNKNOWN_IDX = -1
+# number of batches whose lines are sorted by length together when streaming a dataset
+DEFAULT_BUCKET_BATCHES = 50
+# number of batches prepared ahead by the streaming worker
+DEFAULT_PREFETCH_BATCHES = 4
+
 # tokens that stops either a sentence or a conversation
 STOP_TOKENS = [
     '<eos>']
@@ -100,6 +119,10 @@ class Dictionary(object):
                 tokens = get_tag(tokens, tag)
                 for token in tokens:
                     token_freqs[token] = token_freqs.get(token, 0) + 1
+        return Dictionary.from_freqs(token_freqs, freq_cutoff, init_dict)
+
+    def from_freqs(token_freqs, freq_cutoff=-1, init_dict=True):
+        """Constructs a dictionary of the tokens more frequent than freq_cutoff, most frequent first."""
         dictionary = Dictionary(init=init_dict)
         token_freqs = sorted(token_freqs.items(), key=lambda x: x[1], reverse=True)
         for token, freq in token_freqs:
@@ -107,58 +130,187 @@ class Dictionary(object):
                 dictionary.add_word(token)
         return dictionary
 
+    def from_words(words):
+        """Constructs a dictionary with exactly the given words, in order."""
+        dictionary = Dictionary(init=False)
+        for word in words:
+            dictionary.add_word(word)
+        return dictionary
+
     def from_file(file_name, freq_cutoff):
-        """Constructs a dictionary from the given file."""
+        """Constructs a dictionary from the given file, reading it once."""
         assert os.path.exists(file_name)
-        word_dict = Dictionary.read_tag(file_name, 'dialogue', freq_cutoff=freq_cutoff)
-        item_dict = Dictionary.read_tag(file_name, 'output', init_dict=False)
-        context_dict = Dictionary.read_tag(file_name, 'input', init_dict=False)
+        freqs = {tag: OrderedDict() for tag in TokenStore.FIELDS}
+        with open(file_name, 'r') as f:
+            for line in f:
+                tokens = line.strip().split()
+                for tag, token_freqs in freqs.items():
+                    for token in get_tag(tokens, tag):
+                        token_freqs[token] = token_freqs.get(token, 0) + 1
+        word_dict = Dictionary.from_freqs(freqs['dialogue'], freq_cutoff=freq_cutoff)
+        item_dict = Dictionary.from_freqs(freqs['output'], init_dict=False)
+        context_dict = Dictionary.from_freqs(freqs['input'], init_dict=False)
         return word_dict, item_dict, context_dict
 
 
+class TokenStore(object):
+    """The tokenized lines of a dataset file.
+
+    Every field (the input, dialogue and output tags) is kept as one flat int32
+    array of token indices and an int64 array of the offsets of the lines in it,
+    so a store can be saved as .npy files and memory-mapped back.
+    """
+    FIELDS = ('input', 'dialogue', 'output')
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets['dialogue']) - 1
+
+    def lengths(self, field):
+        """Number of tokens of the field in every line."""
+        return np.diff(self.offsets[field])
+
+    def get(self, field, i):
+        return self.tokens[field][self.offsets[field][i]:self.offsets[field][i + 1]]
+
+    def __getitem__(self, i):
+        return tuple(self.get(field, i).tolist() for field in self.FIELDS)
+
+    def to_list(self):
+        """The lines as (input_idxs, word_idxs, item_idxs) triples of lists."""
+        fields = [[line.tolist() for line in np.split(np.asarray(self.tokens[field]), self.offsets[field][1:-1])]
+                  for field in self.FIELDS]
+        return list(zip(*fields)) if len(self) else []
+
+    def save(self, directory, name):
+        for field in self.FIELDS:
+            np.save(os.path.join(directory, '%s_%s_tokens.npy' % (name, field)), self.tokens[field])
+            np.save(os.path.join(directory, '%s_%s_offsets.npy' % (name, field)), self.offsets[field])
+
+    @staticmethod
+    def load(directory, name, mmap_mode='r'):
+        tokens, offsets = {}, {}
+        for field in TokenStore.FIELDS:
+            tokens[field] = np.load(os.path.join(directory, '%s_%s_tokens.npy' % (name, field)), mmap_mode=mmap_mode)
+            offsets[field] = np.load(os.path.join(directory, '%s_%s_offsets.npy' % (name, field)))
+        return TokenStore(tokens, offsets)
+
+
 class WordCorpus(object):
     """An utility that stores the entire dataset.
 
     It has the train, valid and test datasets and corresponding dictionaries.
+    The dictionaries and the tokenized datasets are cached in cache_dir (by default
+    .corpus_cache inside path), keyed by the content of the dataset files and by
+    freq_cutoff, and memory-mapped from there on later runs.
     """
 
     def __init__(self, path, freq_cutoff=2, train='dataset_train.txt',
-        valid='dataset_val.txt', test='dataset_test.txt', verbose=False):
+        valid='dataset_val.txt', test='dataset_test.txt', verbose=False, cache_dir=None):
         self.verbose = verbose
-        # only add words from the train dataset
-        self.word_dict, self.item_dict, self.context_dict = Dictionary.from_file(
-            os.path.join(path, train),
-            freq_cutoff=freq_cutoff)
-
-        # construct all 3 datasets
-        self.train = self.tokenize(os.path.join(path, train)) if train else []
-        self.valid = self.tokenize(os.path.join(path, valid)) if valid else []
-        self.test = self.tokenize(os.path.join(path, test)) if test else []
+        self.path = path
+        self.freq_cutoff = freq_cutoff
+        file_names = OrderedDict((name, os.path.join(path, file_name)) for name, file_name in
+                                 (('train', train), ('valid', valid), ('test', test)) if file_name)
+        if cache_dir is None:
+            cache_dir = os.path.join(path, CORPUS_CACHE_DIR)
+        cache_dir = os.path.join(cache_dir, self.cache_key(file_names, freq_cutoff))
+        if os.path.exists(cache_dir):
+            self.load(cache_dir, file_names)
+        else:
+            # only add words from the train dataset
+            self.word_dict, self.item_dict, self.context_dict = Dictionary.from_file(
+                file_names['train'], freq_cutoff=freq_cutoff)
+            self.stores = OrderedDict((name, self.tokenize(file_name)) for name, file_name in file_names.items())
+            self.save(cache_dir)
+        self.datasets = {}
 
         # find out the output length from the train dataset
-        self.output_length = max([len(x[2]) for x in self.train])
+        self.output_length = int(self.stores['train'].lengths('output').max())
+
+    def cache_key(self, file_names, freq_cutoff):
+        """Hash of the dataset files and the frequency cutoff."""
+        key = hashlib.sha1(('%d %d' % (CORPUS_CACHE_VERSION, freq_cutoff)).encode())
+        for name, file_name in file_names.items():
+            key.update(name.encode())
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    key.update(chunk)
+        return key.hexdigest()
+
+    def save(self, cache_dir):
+        tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+        try:
+            os.makedirs(tmp_dir)
+            np.savez(os.path.join(tmp_dir, 'dicts.npz'),
+                     word=np.array(self.word_dict.idx2word), item=np.array(self.item_dict.idx2word),
+                     context=np.array(self.context_dict.idx2word), datasets=np.array(list(self.stores.keys())))
+            for name, store in self.stores.items():
+                store.save(tmp_dir, name)
+            os.rename(tmp_dir, cache_dir)
+        except OSError as e:
+            # another run cached the same corpus first, or the cache is not writable
+            logging.info('corpus not cached in %s: %s' % (cache_dir, e))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load(self, cache_dir, file_names):
+        with np.load(os.path.join(cache_dir, 'dicts.npz')) as dicts:
+            self.word_dict = Dictionary.from_words(dicts['word'].tolist())
+            self.item_dict = Dictionary.from_words(dicts['item'].tolist())
+            self.context_dict = Dictionary.from_words(dicts['context'].tolist())
+        self.stores = OrderedDict((name, TokenStore.load(cache_dir, name)) for name in file_names)
+        if self.verbose:
+            for name, file_name in file_names.items():
+                self.log_stats(file_name, self.stores[name])
 
-    def tokenize(self, file_name):
-        """Tokenizes the file and produces a dataset."""
-        lines = read_lines(file_name)
-        random.shuffle(lines)
+    def dataset(self, name):
+        """The dataset as a list of (input_idxs, word_idxs, item_idxs), in a random order."""
+        if name not in self.datasets:
+            self.datasets[name] = self.stores[name].to_list() if name in self.stores else []
+            random.shuffle(self.datasets[name])
+        return self.datasets[name]
 
-        unk = self.word_dict.get_idx('<unk>')
-        dataset, total, unks = [], 0, 0
-        for line in lines:
-            tokens = line.split()
-            input_idxs = self.context_dict.w2i(get_tag(tokens, 'input'))
-            word_idxs = self.word_dict.w2i(get_tag(tokens, 'dialogue'))
-            item_idxs = self.item_dict.w2i(get_tag(tokens, 'output'))
-            dataset.append((input_idxs, word_idxs, item_idxs))
-            # compute statistics
-            total += len(input_idxs) + len(word_idxs) + len(item_idxs)
-            unks += np.count_nonzero([idx == unk for idx in word_idxs])
+    @property
+    def train(self):
+        return self.dataset('train')
+
+    @property
+    def valid(self):
+        return self.dataset('valid')
+
+    @property
+    def test(self):
+        return self.dataset('test')
 
+    def tokenize(self, file_name):
+        """Tokenizes the file and produces a token store."""
+        dicts = {'input': self.context_dict, 'dialogue': self.word_dict, 'output': self.item_dict}
+        tokens = {field: array.array('i') for field in TokenStore.FIELDS}
+        offsets = {field: array.array('q', [0]) for field in TokenStore.FIELDS}
+        assert os.path.exists(file_name), 'file does not exists %s' % file_name
+        with open(file_name, 'r') as f:
+            for line in f:
+                line_tokens = line.split()
+                for field in TokenStore.FIELDS:
+                    # the tokens of the valid and test files may be missing from the input and output dictionaries
+                    idxs = dicts[field].w2i(get_tag(line_tokens, field))
+                    tokens[field].extend(UNKNOWN_IDX if idx is None else idx for idx in idxs)
+                    offsets[field].append(len(tokens[field]))
+        store = TokenStore({field: np.frombuffer(tokens[field], dtype=np.int32) for field in TokenStore.FIELDS},
+                           {field: np.frombuffer(offsets[field], dtype=np.int64) for field in TokenStore.FIELDS})
         if self.verbose:
-            logging.info('dataset %s, total %d, unks %s, ratio %0.2f%%' % (
-                file_name, total, unks, 100. * unks / total))
-        return dataset
+            self.log_stats(file_name, store)
+        return store
+
+    def log_stats(self, file_name, store):
+        unk = self.word_dict.get_idx('<unk>')
+        total = sum(len(store.tokens[field]) for field in TokenStore.FIELDS)
+        unks = np.count_nonzero(store.tokens['dialogue'] == unk)
+        logging.info('dataset %s, total %d, unks %s, ratio %0.2f%%' % (
+            file_name, total, unks, 100. * unks / max(total, 1)))
 
     def train_dataset(self, bsz, shuffle=True, device_id=None):
         return self._split_into_batches(copy.copy(self.train), bsz,
@@ -172,6 +324,12 @@ class WordCorpus(object):
         return self._split_into_batches(copy.copy(self.test), bsz, shuffle=shuffle,
             device_id=device_id)
 
+    def stream_dataset(self, name, bsz, shuffle=True, device_id=None, bucket_batches=DEFAULT_BUCKET_BATCHES,
+                       prefetch=DEFAULT_PREFETCH_BATCHES):
+        """Iterates over the batches of the 'train', 'valid' or 'test' dataset, see BatchIterator."""
+        return BatchIterator(self.stores[name], bsz, self.word_dict.get_idx('<pad>'), shuffle=shuffle,
+                             device_id=device_id, bucket_batches=bucket_batches, prefetch=prefetch)
+
     def _split_into_batches(self, dataset, bsz, shuffle=True, device_id=None):
         """Splits given dataset into batches."""
         if shuffle:
@@ -224,3 +382,112 @@ class WordCorpus(object):
             random.shuffle(batches)
 
         return batches, stats
+
+
+class BatchIterator(object):
+    """Streams the batches of a TokenStore.
+
+    The same (ctx, inpt, tgt, sel_tgt) batches as WordCorpus._split_into_batches
+    are made on the fly, straight from the (memory-mapped) token arrays: the lines
+    are shuffled, cut into buckets of bucket_batches batches, and sorted by
+    dialogue length inside a bucket, so that a batch holds dialogues of similar
+    length. Every batch is padded with one gather. A background thread prepares
+    the next `prefetch` batches while the current one is used. stats counts the
+    tokens and the non padding tokens of the batches made so far.
+    """
+    def __init__(self, store, bsz, pad, shuffle=True, device_id=None, bucket_batches=DEFAULT_BUCKET_BATCHES,
+                 prefetch=DEFAULT_PREFETCH_BATCHES):
+        self.store = store
+        self.bsz = bsz
+        self.pad = pad
+        self.shuffle = shuffle
+        self.device_id = device_id
+        self.bucket_batches = bucket_batches
+        self.prefetch = prefetch
+        self.stats = {
+            'n': 0,
+            'nonpadn': 0
+        }
+
+    def __len__(self):
+        return (len(self.store) + self.bsz - 1) // self.bsz
+
+    def batch_order(self):
+        """The line indices of every batch."""
+        lengths = self.store.lengths('dialogue')
+        order = np.random.permutation(len(lengths)) if self.shuffle else np.arange(len(lengths))
+        bucket_size = self.bsz * self.bucket_batches
+        for start in range(0, len(order), bucket_size):
+            bucket = order[start:start + bucket_size]
+            bucket = bucket[np.argsort(lengths[bucket], kind='mergesort')]
+            batches = [bucket[i:i + self.bsz] for i in range(0, len(bucket), self.bsz)]
+            if self.shuffle:
+                random.shuffle(batches)
+            for batch in batches:
+                yield batch
+
+    def pad_field(self, field, lines, pad):
+        """[len(lines), max_len] array of the field of the lines, padded with pad, and the lengths."""
+        starts = self.store.offsets[field][lines]
+        lengths = self.store.offsets[field][lines + 1] - starts
+        max_len = int(lengths.max())
+        positions = starts[:, None] + np.arange(max_len)[None, :]
+        in_line = np.arange(max_len)[None, :] < lengths[:, None]
+        tokens = self.store.tokens[field]
+        padded = np.asarray(tokens[np.minimum(positions, max(len(tokens) - 1, 0))], dtype=np.int64)
+        padded[~in_line] = pad
+        return padded, lengths
+
+    def make_batch(self, lines):
+        inputs, _ = self.pad_field('input', lines, 0)
+        words, lengths = self.pad_field('dialogue', lines, self.pad)
+        items, _ = self.pad_field('output', lines, 0)
+        self.stats['n'] += words.size
+        self.stats['nonpadn'] += int(lengths.sum())
+        ctx = torch.from_numpy(inputs).t().contiguous()
+        data = torch.from_numpy(words).t().contiguous()
+        sel_tgt = torch.from_numpy(items).t().contiguous().view(-1)
+        return ctx, data, sel_tgt
+
+    def produce(self, batches, stop):
+        try:
+            for lines in self.batch_order():
+                batch = self.make_batch(lines)
+                while not stop.is_set():
+                    try:
+                        batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            batches.put(e)
+            return
+        batches.put(None)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+        worker = threading.Thread(target=self.produce, args=(batches, stop))
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                ctx, data, sel_tgt = batch
+                if self.device_id is not None:
+                    ctx = ctx.cuda(self.device_id)
+                    data = data.cuda(self.device_id)
+                    sel_tgt = sel_tgt.cuda(self.device_id)
+
+                # construct tensor for input and target
+                inpt = data.narrow(0, 0, data.size(0) - 1)
+                tgt = data.narrow(0, 1, data.size(0) - 1).view(-1)
+                yield ctx, inpt, tgt, sel_tgt
+        finally:
+            stop.set()
@@ -13,7 +13,6 @@ import torch.nn as nn
 import torch.nn.init
 from torch.autograd import Variable
 import torch.nn.functional as F
-import numpy as np
 from modules import modules_for_lm
 from modules.modules_for_lm import Criterion
 
@@ -63,6 +62,7 @@ class DialogModel(modules_for_lm.CudaModule):
 
         self.special_token_mask = self.to_device(self.special_token_mask)
         self.crit = Criterion(self.word_dict, device_id=None)
+        self.lm_crit = Criterion(self.word_dict, device_id=None, bad_toks=['<pad>'])
 
 
     def set_device_id(self, device_id):
@@ -120,78 +120,66 @@ class DialogModel(modules_for_lm.CudaModule):
 
     # this is the LSTM network, will be also used in the selfplay mode or in our case in the "fine tune"
 
-    def write(self, lang_h, processed, max_words, temperature, loss, tgt,
+    def write(self, lang_h, processed, max_words, temperature, tgt=None,
             stop_tokens=STOP_TOKENS, resume=False):
-        """Generate a sentence word by word and feed the output of the
-        previous timestep as input to the next.
+        """Generate a sentence word by word for the whole batch at once and feed the
+        output of the previous timestep as input to the next. Rows that generated a
+        stop token get one last update of their hidden state with it, are frozen
+        afterwards and are padded with <pad>. In train_em mode the words of tgt are fed
+        instead of the generated ones; its loss is computed by teacher_forced_loss.
         """
-        encoded_pad = self.word_dict.w2i(['<pad>'])
-        btz_size = lang_h.size()[1]
-        outs_btz = torch.LongTensor(size=[max_words,btz_size])
-        # scores_loss = Variable(torch.FloatTensor(size=[max_words, btz_total, len(self.word_dict.idx2word)]))
-        for btz in range(btz_size):
-            tgt_btz = torch.LongTensor([tgt[i] for i in range(btz,tgt.shape[0],btz_size)])
-            processed_btz = processed[:,btz,:]
-            outs, logprobs, lang_hs = [], [], []
-            # remove batch dimension from the language and context hidden states
-            if resume:
-                inpt = None
+        encoded_pad = self.word_dict.get_idx('<pad>')
+        stop_idx = self.to_device(torch.LongTensor(self.word_dict.w2i(stop_tokens)))
+        btz_size = lang_h.size(1)
+        processed = processed[0]
+        lang_h = lang_h[0]
+        if self.mode == 'train_em':
+            tgt = tgt.view(-1, btz_size)
+        outs = self.to_device(torch.LongTensor(max_words, btz_size).fill_(encoded_pad))
+        lang_hs = []
+        # rows that have not generated a stop token yet
+        active = self.to_device(torch.ones(btz_size, dtype=torch.bool))
+        # rows whose hidden state is still updated: the active ones and those that just stopped
+        stepping = active
+        if resume:
+            inpt = None
+        else:
+            inpt = self.to_device(torch.LongTensor(btz_size).fill_(self.word_dict.get_idx('Hi')))
+        # generate words until max_words have been generated or every row generated <eos>
+        for word_idx in range(max_words):
+            if inpt is not None:
+                # add the context to the word embedding and update RNN state with last word
+                inpt_emb = torch.cat([self.word_encoder(inpt), processed], 1)
+                lang_h = torch.where(stepping.unsqueeze(1), self.writer(inpt_emb, lang_h), lang_h)
+                lang_hs.append(lang_h.unsqueeze(0))
+            stepping = active
+            if not active.any():
+                break
+            # decode words using the inverse of the word embedding matrix
+            out = self.decoder(lang_h)
+            scores = F.linear(out, self.word_encoder.weight).div(temperature)
+            # subtract constant to avoid overflows in exponentiation
+            scores = scores - scores.max(1, keepdim=True)[0].detach()
+            # disable special tokens from being generated in a normal turns
+            if not resume:
+                scores = scores + self.special_token_mask
+            prob = F.softmax(scores, dim=1)
+            word = prob.multinomial(num_samples=1).detach().squeeze(1)
+            outs[word_idx] = torch.where(active, word, outs[word_idx])
+            if self.mode == 'train_em':
+                inpt = tgt[word_idx]
             else:
-                inpt = Variable(torch.LongTensor(1))
-                inpt.data.fill_(self.word_dict.get_idx('Hi'))
-                inpt = self.to_device(inpt)
-            # generate words until max_words have been generated or <eos>
-            for word_idx in range(max_words):
-                if inpt is not None:
-                    # add the context to the word embedding
-                    inpt_emb = torch.cat([self.word_encoder(inpt), processed_btz], 1)
-                    # update RNN state with last word
-                    lang_h[:, btz, :] = self.writer(inpt_emb, lang_h[:, btz, :])
-                    lang_hs.append(lang_h[:, btz, :])
-                # decode words using the inverse of the word embedding matrix
-
-                out = self.decoder(lang_h[:, btz, :])
-                scores = Variable(F.linear(out, self.word_encoder.weight).div(temperature))
-                # subtract constant to avoid overflows in exponentiation
-                scores = Variable(scores.add(-scores.max().item()).squeeze(0))
-                # disable special tokens from being generated in a normal turns
-                if not resume:
-                    mask = Variable(self.special_token_mask)
-                    scores = scores.add(mask)
-                prob = F.softmax(scores,dim=0)
-                logprob = F.log_softmax(scores,dim=0)
-
-                # explicitly defining num_samples for pytorch 0.4.1
-                word = prob.multinomial(num_samples=1).detach()
-                # logprob = logprob.gather(0, word)
-
-                # logprobs.append(logprob)
-
-                outs.append(word.view(word.size()[0], 1))
-                if self.mode == 'train_em':
-                    loss += self.crit(scores.view(-1, len(self.word_dict)), tgt_btz[word_idx].unsqueeze(0))
-                    inpt = tgt_btz[word_idx].unsqueeze(0)
-                else:
-                    inpt = word
-                # scores_loss[word_idx, btz] = Variable(scores)
-
-                # check if we generated an <eos> token
-                if self.word_dict.get_word(word.data[0]) in stop_tokens:
-                    break
-            # update the hidden state with the <eos> token
-            inpt_emb = torch.cat([self.word_encoder(inpt), processed_btz], 1)
-            lang_h[:, btz, :] = self.writer(inpt_emb, lang_h[:, btz, :])
-            lang_hs.append(lang_h[:, btz, :])
-
-            # add batch dimension back
-            # lang_h = lang_h.unsqueeze(1)
-            if len(outs)<max_words:
-                outs = [outs[i].item() for i in range(len(outs))]
-                outs = outs + encoded_pad * (max_words - len(outs))
-                outs = [torch.LongTensor([[i]]) for i in outs]
-            outs_btz[:,btz] = torch.cat(outs).squeeze(1)
-            lang_hs += [torch.cat(lang_hs)]
-        return outs_btz, lang_h, lang_hs, loss
+                inpt = word
+            # check if we generated an <eos> token
+            active = active & (word.unsqueeze(1) != stop_idx).all(1)
+        else:
+            # update the hidden state with the last word of the rows that got to max_words
+            inpt_emb = torch.cat([self.word_encoder(inpt), processed], 1)
+            lang_h = torch.where(stepping.unsqueeze(1), self.writer(inpt_emb, lang_h), lang_h)
+            lang_hs.append(lang_h.unsqueeze(0))
+
+        lang_hs += [torch.cat(lang_hs)]
+        return outs, lang_h.unsqueeze(0), lang_hs
 
     def forward_lm(self, inpt, lang_h, ctx_h):
         """Run forward pass for language modeling."""
@@ -214,3 +202,10 @@ class DialogModel(modules_for_lm.CudaModule):
         decoded = F.linear(decoded, self.word_encoder.weight)
 
         return decoded.view(out.size(0), out.size(1), decoded.size(1)) , out
+
+    def teacher_forced_loss(self, inpt, tgt, lang_h, ctx_h):
+        """Language modeling loss of a whole padded batch: the reader runs over inpt
+        [max_words, batch_size] in one call and every next word in tgt is scored with
+        a single Criterion call, <pad> targets are ignored."""
+        out, _ = self.forward_lm(inpt, lang_h, ctx_h)
+        return self.lm_crit(out.view(-1, out.size(2)), tgt.view(-1))
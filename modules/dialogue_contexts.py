@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+import torch
+
+from modules.data import UNKNOWN_IDX
+
+"""
+    The context vectors that condition the language model on the corpus dialogues.
+    The <input> of a dialogue holds 4 tokens per agent: its color and shape and the
+    color and shape of its goal landmark. A DialogueContexts keeps one context vector
+    per distinct input (a signature) and picks the vector of every dialogue of a batch
+    from its own input tokens, by an exact mixed-radix key of the tokens. Inputs that
+    are not in the table, or that hold tokens missing from the input dictionary, get a
+    zero context.
+"""
+
+FIELDS_PER_AGENT = 4
+
+
+def input_signatures(corpus):
+    """The distinct inputs of the corpus datasets, padded with 0 as in the batches: [n, max_len], and their
+    lengths [n]. Inputs that differ only in trailing padding cannot be told apart in a batch and share a row."""
+    stores = [store for store in corpus.stores.values() if len(store)]
+    lengths = np.concatenate([store.lengths('input') for store in stores])
+    max_len = int(lengths.max())
+    padded = np.zeros((len(lengths), max_len), dtype=np.int64)
+    padded[np.arange(max_len)[None, :] < lengths[:, None]] = np.concatenate(
+        [np.asarray(store.tokens['input'][:store.offsets['input'][-1]]) for store in stores])
+    signatures, first = np.unique(padded, axis=0, return_index=True)
+    return signatures, lengths[first]
+
+
+class DialogueContexts(object):
+    def __init__(self, signatures, contexts, num_tokens):
+        """signatures [n, length] (padded with 0) hold the inputs whose context vectors are contexts [n, nhid];
+        num_tokens is the size of the input dictionary."""
+        self.length = signatures.size(1)
+        self.base = num_tokens + 1
+        if self.length * math.log2(self.base) >= 63:
+            raise ValueError('inputs of %d tokens out of %d do not fit a key' % (self.length, num_tokens))
+        known = (signatures != UNKNOWN_IDX).all(1)
+        keys, order = torch.sort(self.keys(signatures[known]))
+        self.sorted_keys = keys
+        self.contexts = torch.cat((contexts[known][order], contexts.new_zeros(1, contexts.size(1))))
+
+    def keys(self, inputs):
+        """Key of every row of inputs [n, length]; the unknown tokens map to 0."""
+        powers = self.base ** torch.arange(self.length, dtype=torch.long)
+        return ((inputs.long() + 1) * powers).sum(1)
+
+    def __call__(self, ctx):
+        """Context vectors [1, batch, nhid] of the dialogues of a batch from their input tokens [ctx_len, batch]."""
+        inputs = ctx.t().cpu()
+        missing = len(self.sorted_keys)
+        if inputs.size(1) > self.length or not missing:
+            rows = torch.full((inputs.size(0),), missing, dtype=torch.long)
+        else:
+            inputs = torch.cat((inputs, inputs.new_zeros(inputs.size(0), self.length - inputs.size(1))), 1)
+            keys = self.keys(inputs)
+            rows = torch.searchsorted(self.sorted_keys, keys).clamp(max=missing - 1)
+            found = (self.sorted_keys[rows] == keys) & (inputs != UNKNOWN_IDX).all(1)
+            rows = rows.masked_fill(~found, missing)
+        return self.contexts.index_select(0, rows.to(self.contexts.device)).unsqueeze(0)
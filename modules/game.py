@@ -2,6 +2,8 @@ import logging
 
 import torch
 import torch.nn as nn
+from modules.game_step import GameStep
+from modules.memory_bank import MemoryBank
 from modules.plot import Plot
 from torch.autograd import Variable
 
@@ -22,25 +24,52 @@ from torch.autograd import Variable
             -utterance: [num_agents, num_agents, memory_size]
             -physical:[num_agents, num_agents + num_landmarks, memory_size]
             -action: [num_agents, memory_size]
+          kept in a MemoryBank that is committed once per timestep
 
         config needs: -batch_size, -using_utterances, -world_dim, -vocab_size, -memory_size, -num_colors -num_shapes
+
+    The colors and shapes [batch_size, num_entities, 1] of the entities, and for every goal the agent
+    [batch_size, num_agents, 1] it belongs to and its landmark entity [batch_size, num_agents, 1],
+    are random unless they are given.
+
+    num_agents and num_landmarks are either scalars or LongTensors of shape [batch_size]
+    holding the counts of every game. Mixed-size batches are padded to the largest game:
+        -agent_mask: [batch_size, num_agents], True for the real agents of each game
+        -entity_mask: [batch_size, num_agents + num_landmarks], True for the real entities
+    Padded agents do not move and padded entities are left out of the pooling and the costs.
 """
 
 
+def entity_counts(num, batch_size):
+    if torch.is_tensor(num):
+        return num.long()
+    return torch.LongTensor(batch_size).fill_(num)
+
+
 class GameModule(nn.Module):
 
-    def __init__(self, config, num_agents, num_landmarks, folder_dir):
+    def __init__(self, config, num_agents, num_landmarks, folder_dir, colors=None, shapes=None, goal_agents=None,
+                 goal_entities=None):
         super(GameModule, self).__init__()
 
         self.batch_size = config.batch_size # scalar: num games in this batch
         self.using_utterances = config.use_utterances # bool: whether current batch allows utterances
         self.using_cuda = config.use_cuda
-        self.num_agents = num_agents # scalar: number of agents in this batch
-        self.num_landmarks = num_landmarks # scalar: number of landmarks in this batch
+        self.agent_counts = entity_counts(num_agents, self.batch_size) # [batch_size]: num agents in each game
+        self.landmark_counts = entity_counts(num_landmarks, self.batch_size) # [batch_size]: num landmarks in each game
+        self.num_agents = int(self.agent_counts.max()) # scalar: number of (padded) agents in this batch
+        self.num_landmarks = int(self.landmark_counts.max()) # scalar: number of (padded) landmarks in this batch
         self.num_entities = self.num_agents + self.num_landmarks # type: int
+        self.padded = bool((self.agent_counts < self.num_agents).any() or (self.landmark_counts < self.num_landmarks).any())
+        self.agent_mask = torch.arange(self.num_agents).unsqueeze(0) < self.agent_counts.unsqueeze(1)
+        landmark_mask = torch.arange(self.num_landmarks).unsqueeze(0) < self.landmark_counts.unsqueeze(1)
+        self.entity_mask = torch.cat((self.agent_mask, landmark_mask), 1)
+        # [batch_size, num_agents, num_agents]: pairs of real agents
+        self.agent_pair_mask = self.agent_mask.unsqueeze(2) & self.agent_mask.unsqueeze(1)
         self.world_dim = config.world_dim
         self.time_horizon = config.time_horizon
         self.num_epochs = config.num_epochs
+        self.fused_step = config.fused_step # bool: whether the step and its cost run as one fused autograd node
         self.folder_dir = folder_dir
         if self.using_cuda:
             self.Tensor = torch.cuda.FloatTensor
@@ -48,60 +77,64 @@ class GameModule(nn.Module):
             self.Tensor = torch.FloatTensor
 
         locations = torch.rand(self.batch_size, self.num_entities, 2) * config.world_dim
-        self.colors = (torch.rand(self.batch_size, self.num_entities, 1) * config.num_colors).floor()
-        self.shapes = (torch.rand(self.batch_size, self.num_entities, 1) * config.num_shapes).floor()
-
-        goal_agents = self.Tensor(self.batch_size, self.num_agents, 1)
-        self.goal_entities = (torch.rand(self.batch_size, self.num_agents, 1) * self.num_landmarks).floor().long() + self.num_agents
-        goal_locations = self.Tensor(self.batch_size, self.num_agents, 2)
+        # the attributes and goals are drawn at random unless they are given
+        if colors is None:
+            colors = (torch.rand(self.batch_size, self.num_entities, 1) * config.num_colors).floor()
+        if shapes is None:
+            shapes = (torch.rand(self.batch_size, self.num_entities, 1) * config.num_shapes).floor()
+        self.colors = colors.float()
+        self.shapes = shapes.float()
+
+        if goal_agents is None:
+            # a random permutation of the agents for every game at once: argsort of random keys,
+            # padded agents get keys above all real ones so each game permutes only its real agents
+            goal_keys = torch.rand(self.batch_size, self.num_agents).masked_fill(~self.agent_mask, 2)
+            goal_agents = torch.sort(goal_keys, 1)[1].unsqueeze(2)
+        goal_agents = goal_agents.float()
+        if goal_entities is None:
+            goal_entities = (torch.rand(self.batch_size, self.num_agents, 1) *
+                             self.landmark_counts.view(-1, 1, 1).float()).floor().long() + self.num_agents
+        self.goal_entities = goal_entities.long()
 
         if self.using_cuda:
             locations = locations.cuda()
             self.colors = self.colors.cuda()
             self.shapes = self.shapes.cuda()
             self.goal_entities = self.goal_entities.cuda()
+            goal_agents = goal_agents.cuda()
+            self.agent_mask = self.agent_mask.cuda()
+            self.entity_mask = self.entity_mask.cuda()
+            self.agent_pair_mask = self.agent_pair_mask.cuda()
 
         # [batch_size, num_entities, 2]
         self.locations = Variable(locations)
         # [batch_size, num_entities, 2]
         self.physical = Variable(torch.cat((self.colors, self.shapes), 2).float())
 
-        for b in range(self.batch_size):
-            goal_agents[b, :, 0] = torch.randperm(self.num_agents)
-
-        for b in range(self.batch_size):
-            goal_locations[b] = self.locations.data[b][self.goal_entities[b].squeeze()]
+        goal_locations = self.locations.data.gather(1, self.goal_entities.expand(-1, -1, 2))
 
         # [batch_size, num_agents, 3]
         self.goals = Variable(torch.cat((goal_locations, goal_agents), 2))
         goal_agents = Variable(goal_agents)
 
-        if self.using_cuda:
-            self.memories = {
-                "physical": Variable(torch.zeros(self.batch_size, self.num_agents, self.num_entities, config.memory_size).cuda()),
-                "action": Variable(torch.zeros(self.batch_size, self.num_agents, config.memory_size).cuda())}
-        else:
-            self.memories = {
-                "physical": Variable(torch.zeros(self.batch_size, self.num_agents, self.num_entities, config.memory_size)),
-                "action": Variable(torch.zeros(self.batch_size, self.num_agents, config.memory_size))}
-
+        memories = {
+            "physical": Variable(torch.zeros(self.batch_size, self.num_agents, self.num_entities, config.memory_size)),
+            "action": Variable(torch.zeros(self.batch_size, self.num_agents, config.memory_size))}
         if self.using_utterances:
-            if self.using_cuda:
-                self.utterances = Variable(torch.zeros(self.batch_size, self.num_agents, config.vocab_size).cuda())
-                self.memories["utterance"] = Variable(torch.zeros(self.batch_size, self.num_agents, self.num_agents, config.memory_size).cuda())
-            else:
-                self.utterances = Variable(torch.zeros(self.batch_size, self.num_agents, config.vocab_size))
-                self.memories["utterance"] = Variable(torch.zeros(self.batch_size, self.num_agents, self.num_agents, config.memory_size))
+            self.utterances = Variable(torch.zeros(self.batch_size, self.num_agents, config.vocab_size))
+            memories["utterance"] = Variable(torch.zeros(self.batch_size, self.num_agents, self.num_agents, config.memory_size))
+        if self.using_cuda:
+            memories = {mem_str: mem.cuda() for mem_str, mem in memories.items()}
+            if self.using_utterances:
+                self.utterances = self.utterances.cuda()
+        self.memories = MemoryBank(memories)
 
         agent_baselines = self.locations[:, :self.num_agents, :]
         self.goals_by_landmark = torch.cat((self.goal_entities.type(torch.FloatTensor), goal_agents), 2).float()
 
+        # [batch_size, num_agents, 2]: sorted_goals[b, a] is the goal that agent a has to reach
         sort_idxs = torch.sort(self.goals[:,:,2])[1]
-        self.sorted_goals = Variable(self.Tensor(self.goals.size()))
-        # TODO: Bad for loop?
-        for b in range(self.batch_size):
-            self.sorted_goals[b] = self.goals[b][sort_idxs[b]]
-        self.sorted_goals = self.sorted_goals[:,:,:2]
+        self.sorted_goals = self.goals.gather(1, sort_idxs.unsqueeze(2).expand_as(self.goals))[:,:,:2]
 
         # [batch_size, num_agents, num_entities, 2]
         self.observations = self.locations.unsqueeze(1) - agent_baselines.unsqueeze(2)
@@ -113,7 +146,8 @@ class GameModule(nn.Module):
 
         self.plots_matrix = Plot(self.batch_size,self.time_horizon, self.num_entities,
                                  locations.shape[2], self.world_dim, self.num_agents,
-                                 self.goals_by_landmark, self.folder_dir)
+                                 self.goals_by_landmark, self.folder_dir,
+                                 config.trajectory_queue_size, config.drop_trajectories)
         self.plots_matrix.save_plot_matrix("start", locations, self.colors, self.shapes)
     """
     Updates game state given all movements and utterances and returns accrued cost
@@ -124,25 +158,67 @@ class GameModule(nn.Module):
         - scalar: total cost of all games in the batch
     """
     def forward(self, movements, goal_predictions, utterances, t, utterance_super):
-        self.locations = self.locations + movements
+        cost = self.step(movements, goal_predictions, utterances)
         self.plots_matrix.save_plot_matrix(t, self.locations, self.colors, self.shapes) ####
+        if self.using_utterances:
+            self.plots_matrix.save_utterance_matrix(utterances, t) ####
+            if utterance_super is not None:
+                self.plots_matrix.save_utterance_matrix(utterance_super,t, mode='super')
+        return cost
+
+    """
+    Records the trajectory of the played episode, together with the given records
+    (e.g. the final distances from the goals), as one episode of the run's trajectories
+    """
+    def save_trajectory(self, records=None):
+        self.plots_matrix.save_h5_file(records)
+
+    """
+    Updates the game state like forward, without recording the timestep for the plots
+    """
+    def step(self, movements, goal_predictions, utterances):
+        if self.padded:
+            movements = movements.masked_fill(~self.entity_mask.unsqueeze(2), 0)
+        if self.using_utterances:
+            self.utterances = utterances
+        if self.fused_step:
+            return self.fused_forward(movements, goal_predictions)
+        self.locations = self.locations + movements
         agent_baselines = self.locations[:, :self.num_agents]
         self.observations = self.locations.unsqueeze(1)- agent_baselines.unsqueeze(2)
         new_obs = self.goals[:,:,:2] - agent_baselines
         goal_agents = self.goals[:,:,2].unsqueeze(2)
         self.observed_goals = torch.cat((new_obs, goal_agents), dim=2)
+        return self.compute_cost(movements, goal_predictions, utterances)
+
+    """
+    Cuts the autograd history of the game state so that truncated backprop can carry
+    the state over to the next chunk of timesteps
+    """
+    def detach_state(self):
+        self.locations = self.locations.detach()
+        self.observations = self.observations.detach()
+        self.observed_goals = self.observed_goals.detach()
         if self.using_utterances:
-            self.utterances = utterances
-            self.plots_matrix.save_utterance_matrix(utterances, t) ####
-            self.plots_matrix.save_utterance_matrix(utterance_super,t, mode='super')
-            return self.compute_cost(movements, goal_predictions, utterances)
-        else:
-            return self.compute_cost(movements, goal_predictions)
+            self.utterances = self.utterances.detach()
+        self.memories.detach()
+
+    """
+    Runs the location update, the observations and all three cost terms as a single
+    GameStep autograd node instead of one small node per operation
+    """
+    def fused_forward(self, movements, goal_predictions):
+        agent_mask = self.agent_mask if self.padded else None
+        agent_pair_mask = self.agent_pair_mask if self.padded else None
+        self.locations, self.observations, self.observed_goals, physical_cost, goal_pred_cost, movement_cost = \
+            GameStep.apply(self.locations, movements, self.goals, self.sorted_goals, goal_predictions,
+                           agent_mask, agent_pair_mask)
+        return physical_cost + goal_pred_cost + movement_cost
 
     def compute_cost(self, movements, goal_predictions, utterances=None):
         physical_cost = self.compute_physical_cost()
         movement_cost = self.compute_movement_cost(movements)
-        goal_pred_cost = self.compute_goal_pred_cost(goal_predictions)
+        goal_pred_cost = self.compute_goal_pred_cost(goal_predictions) if goal_predictions is not None else 0
         return physical_cost + goal_pred_cost + movement_cost
 
     """
@@ -150,15 +226,7 @@ class GameModule(nn.Module):
     agent locations are stored as [batch_size, num_agents + num_landmarks, entity_embed_size]
     """
     def compute_physical_cost(self):
-        return 2*torch.sum(
-                    torch.sqrt(
-                        torch.sum(
-                            torch.pow(
-                                self.locations[:,:self.num_agents,:] - self.sorted_goals,
-                                2),
-                            -1)
-                        )
-                    )
+        return 2*self.sum_of_norms(self.locations[:,:self.num_agents,:] - self.sorted_goals, self.agent_mask)
 
     """
     Computes the total cost agents get from predicting others' goals
@@ -178,21 +246,25 @@ class GameModule(nn.Module):
         relative_goal_locs = self.goals.unsqueeze(1)[:,:,:,:2] - self.locations.unsqueeze(2)[:, :self.num_agents, :, :]
         goal_agents = self.goals.unsqueeze(1)[:,:,:,2:].expand_as(relative_goal_locs)[:,:,:,-1:]
         relative_goals =  torch.cat((relative_goal_locs, goal_agents), dim=3)
-        return torch.sum(
-                torch.sqrt(
-                    torch.sum(
-                        torch.pow(
-                            goal_predictions - relative_goals,
-                            2),
-                        -1)
-                    )
-                )
+        return self.sum_of_norms(goal_predictions - relative_goals, self.agent_pair_mask)
 
     """
     Computes the total cost agents get from moving
     """
     def compute_movement_cost(self, movements):
-        return torch.sum(torch.sqrt(torch.sum(torch.pow(movements[:,:self.num_agents,:], 2), -1)))
+        return self.sum_of_norms(movements[:,:self.num_agents,:], self.agent_mask)
+
+    """
+    Sums the euclidean norms of diff over its last dim, counting only the cells of real
+    agents in padded batches. Padded cells are given a unit norm before the sqrt so they
+    do not send nan gradients back through the mask.
+    """
+    def sum_of_norms(self, diff, mask):
+        squared = torch.sum(torch.pow(diff, 2), -1)
+        if not self.padded:
+            return torch.sum(torch.sqrt(squared))
+        squared = torch.where(mask, squared, torch.ones_like(squared))
+        return torch.sum(torch.sqrt(squared).masked_fill(~mask, 0))
 
 
         #dist, dist_per_agent = game.get_avg_agent_to_goal_distance() #add to tensorboard
@@ -200,6 +272,8 @@ class GameModule(nn.Module):
     def get_avg_agent_to_goal_distance(self):
         dist_from_goal = self.locations[:,:self.num_agents,:] - self.sorted_goals
         euclidean_distance_per_batch =  torch.sqrt(torch.sum(torch.pow(dist_from_goal,2), -1))
+        if self.padded:
+            euclidean_distance_per_batch = euclidean_distance_per_batch.masked_fill(~self.agent_mask, 0)
         return torch.sum(euclidean_distance_per_batch), euclidean_distance_per_batch
 
 
@@ -0,0 +1,70 @@
+import torch
+
+"""
+    GameStep fuses one timestep of the game dynamics and its cost into a single
+    autograd node with an analytic backward. Given the entity locations and the
+    movements of the timestep it returns:
+        -locations: [batch_size, num_entities, 2] the moved entities
+        -observations: [batch_size, num_agents, num_entities, 2] locations relative to each agent
+        -observed_goals: [batch_size, num_agents, 3] goals relative to the agent that holds them
+        -physical_cost, goal_pred_cost, movement_cost: scalars, as in GameModule.compute_cost
+    goal_predictions may be None (no utterances), and agent_mask / agent_pair_mask are
+    None unless the batch mixes game sizes. Norms of zero length get a zero gradient.
+"""
+class GameStep(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, locations, movements, goals, sorted_goals, goal_predictions, agent_mask, agent_pair_mask):
+        num_agents = goals.size(1)
+        new_locations = locations + movements
+        agent_locations = new_locations[:, :num_agents]
+        observations = new_locations.unsqueeze(1) - agent_locations.unsqueeze(2)
+        observed_goals = torch.cat((goals[:, :, :2] - agent_locations, goals[:, :, 2:]), 2)
+
+        physical_cost, goal_unit = GameStep.sum_of_norms(agent_locations - sorted_goals, agent_mask)
+        movement_cost, movement_unit = GameStep.sum_of_norms(movements[:, :num_agents], agent_mask)
+        if goal_predictions is not None:
+            relative_goal_locs = goals.unsqueeze(1)[:, :, :, :2] - agent_locations.unsqueeze(2)
+            relative_goals = torch.cat(
+                (relative_goal_locs, goals.unsqueeze(1)[:, :, :, 2:].expand(-1, num_agents, -1, -1)), 3)
+            goal_pred_cost, prediction_unit = GameStep.sum_of_norms(goal_predictions - relative_goals, agent_pair_mask)
+        else:
+            goal_pred_cost = physical_cost.new_zeros(())
+            prediction_unit = None
+
+        ctx.num_agents = num_agents
+        ctx.has_predictions = goal_predictions is not None
+        ctx.save_for_backward(goal_unit, movement_unit, prediction_unit)
+        return new_locations, observations, observed_goals, 2 * physical_cost, goal_pred_cost, movement_cost
+
+    @staticmethod
+    def backward(ctx, grad_locations, grad_observations, grad_observed_goals,
+                 grad_physical, grad_goal_pred, grad_movement):
+        goal_unit, movement_unit, prediction_unit = ctx.saved_tensors
+        num_agents = ctx.num_agents
+
+        # gradient w.r.t. the moved locations, collected from every output that reads them
+        grad_new = grad_locations + grad_observations.sum(1)
+        grad_agents = grad_new[:, :num_agents]
+        grad_agents -= grad_observations.sum(2)
+        grad_agents -= grad_observed_goals[:, :, :2]
+        grad_agents += 2 * grad_physical * goal_unit
+        grad_predictions = None
+        if ctx.has_predictions:
+            grad_predictions = grad_goal_pred * prediction_unit
+            grad_agents += grad_predictions[:, :, :, :2].sum(2)
+
+        grad_movements = grad_new.clone()
+        grad_movements[:, :num_agents] += grad_movement * movement_unit
+        return grad_new, grad_movements, None, None, grad_predictions, None, None
+
+    @staticmethod
+    def sum_of_norms(diff, mask):
+        """Returns the (masked) sum of the euclidean norms over the last dim and their unit vectors."""
+        norms = torch.sqrt(torch.sum(torch.pow(diff, 2), -1, keepdim=True))
+        unit = torch.where(norms > 0, diff / norms.clamp(min=1e-20), torch.zeros_like(diff))
+        if mask is not None:
+            mask = mask.unsqueeze(-1)
+            norms = norms.masked_fill(~mask, 0)
+            unit = unit.masked_fill(~mask, 0)
+        return norms.sum(), unit
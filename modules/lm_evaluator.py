@@ -0,0 +1,85 @@
+import math
+import multiprocessing
+import queue
+
+import torch
+from modules import data
+from modules.dialog_model import DialogModel
+from modules.modules_for_lm import Criterion
+
+"""
+    Validation of the DialogModel language model on the valid/test datasets of a
+    WordCorpus. evaluate_lm streams a dataset in large padded batches through
+    forward_lm without building graphs and returns the loss per target token
+    (<pad> targets are skipped) and the perplexity. An LMEvaluator runs it in a
+    worker process: submit() hands it a CPU snapshot of the weights and returns at
+    once, and results() returns the (step, dataset, loss, perplexity) of the
+    finished evaluations, so training is never blocked by validation.
+"""
+
+
+def evaluate_lm(model, corpus, dataset, contexts, batch_size):
+    """Loss per target token and perplexity of the model on the 'valid' or 'test' dataset; contexts gives
+    the context vectors of a batch from its input tokens (see DialogueContexts)."""
+    crit = Criterion(corpus.word_dict, bad_toks=['<pad>'], reduction='sum')
+    pad = corpus.word_dict.get_idx('<pad>')
+    was_training = model.training
+    model.eval()
+    total_loss, total_tokens = 0.0, 0
+    with torch.no_grad():
+        for ctx, inpt, tgt, _ in corpus.stream_dataset(dataset, batch_size, shuffle=False):
+            out, _ = model.forward_lm(inpt, model.zero_hid(inpt.size(1)), contexts(ctx))
+            total_loss += crit(out.view(-1, out.size(2)), tgt).item()
+            total_tokens += int((tgt != pad).sum())
+    model.train(was_training)
+    loss = total_loss / max(total_tokens, 1)
+    return loss, math.exp(min(loss, 100))
+
+
+def evaluate_worker(requests, results, corpus_path, freq_cutoff, config, contexts, batch_size):
+    # the corpus is loaded from its on-disk cache instead of being copied into the worker
+    corpus = data.WordCorpus(corpus_path, freq_cutoff=freq_cutoff)
+    model = DialogModel(corpus.word_dict, None, None, 4, config, None, 'eval')
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        step, dataset, state_dict = request
+        model.load_state_dict(state_dict)
+        loss, perplexity = evaluate_lm(model, corpus, dataset, contexts, batch_size)
+        results.put((step, dataset, loss, perplexity))
+
+
+class LMEvaluator(object):
+    def __init__(self, corpus, config, contexts, batch_size):
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results_queue = context.Queue()
+        self.worker = context.Process(target=evaluate_worker, args=(
+            self.requests, self.results_queue, corpus.path, corpus.freq_cutoff, config, contexts, batch_size))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, snapshot, step, dataset='valid'):
+        """Queues the evaluation of a CPU state dict snapshot of the model."""
+        self.requests.put((step, dataset, snapshot))
+
+    def results(self, block=False):
+        """The finished evaluations; with block, waits for at least one."""
+        finished = []
+        try:
+            finished.append(self.results_queue.get(block=block))
+            while True:
+                finished.append(self.results_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return finished
+
+    def close(self):
+        """Waits for the queued evaluations, returns their results and stops the worker."""
+        self.requests.put(None)
+        finished = []
+        while self.worker.is_alive() or not self.results_queue.empty():
+            finished += self.results(block=False)
+            self.worker.join(0.1)
+        return finished + self.results(block=False)
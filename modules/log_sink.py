@@ -0,0 +1,101 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+"""
+    A LogSink appends text records to one log file without opening it on every
+    write. Records are buffered and handed to a background thread, which keeps the
+    file open, once the buffer holds flush_size characters or flush_interval
+    seconds passed since the last flush. get_sink returns one shared sink per path,
+    so every writer of a file goes through the same buffer and keeps its order.
+    sampled(batch) tells whether a batch is logged at all: only every
+    sample_every-th batch is. All sinks are closed (flushed) at exit.
+"""
+
+DEFAULT_FLUSH_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 10.0
+
+sinks = {}
+sinks_lock = threading.Lock()
+
+
+def get_sink(path, sample_every=1, flush_size=DEFAULT_FLUSH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    path = os.path.abspath(path)
+    with sinks_lock:
+        if path not in sinks:
+            sinks[path] = LogSink(path, sample_every, flush_size, flush_interval)
+        return sinks[path]
+
+
+def close_all():
+    with sinks_lock:
+        for sink in sinks.values():
+            sink.close()
+        sinks.clear()
+
+
+atexit.register(close_all)
+
+
+class LogSink(object):
+    def __init__(self, path, sample_every=1, flush_size=DEFAULT_FLUSH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.sample_every = max(sample_every, 1)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered = 0
+        self.batches = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.file = open(path, 'a', newline='')
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sampled(self, batch=None):
+        """Whether the given batch (or, without one, the next batch written to this sink) is logged."""
+        if batch is None:
+            batch = self.batches
+            self.batches += 1
+        return batch % self.sample_every == 0
+
+    def write(self, text):
+        with self.lock:
+            self.buffer.append(text)
+            self.buffered += len(text)
+            full = self.buffered >= self.flush_size or time.time() - self.last_flush >= self.flush_interval
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.queue.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+            self.last_flush = time.time()
+
+    def write_loop(self):
+        while True:
+            text = self.queue.get()
+            if text is None:
+                return
+            try:
+                self.file.write(text)
+                self.file.flush()
+            except (IOError, OSError) as e:
+                logging.warning('writing log %s failed: %s', self.path, e)
+
+    def close(self):
+        """Writes the buffered records and stops the writer thread."""
+        if self.thread is not None:
+            self.flush()
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.file.close()
@@ -0,0 +1,59 @@
+import torch
+
+"""
+    A MemoryBank holds the independent memories of a game ("physical", "utterance"
+    and "action"), each shaped [batch_size, ..., memory_size]. Reads during a
+    timestep always see the state the timestep started from, while writes go in
+    place into that timestep's buffer, so updating a single agent/entity cell
+    neither copies the untouched cells nor cuts their autograd history. A whole
+    timestep's update can also be written at once, which just swaps the buffer.
+    commit() closes the timestep and appends its state to self.states.
+"""
+class MemoryBank(object):
+    def __init__(self, memories, keep_states=True):
+        self.current = dict(memories)
+        self.pending = {}
+        self.written = {}
+        self.keep_states = keep_states
+        self.states = [dict(self.current)] if keep_states else []
+
+    def __getitem__(self, mem_str):
+        return self.current[mem_str]
+
+    def __contains__(self, mem_str):
+        return mem_str in self.current
+
+    def keys(self):
+        return self.current.keys()
+
+    def write(self, mem_str, new_mem, *index):
+        """Writes new_mem into memories[mem_str][:, *index] for the current timestep."""
+        if not index:
+            self.pending[mem_str] = new_mem
+            self.written[mem_str] = None
+            return
+        if mem_str not in self.pending:
+            mem = self.current[mem_str]
+            self.pending[mem_str] = mem.new_empty(mem.size())
+            self.written[mem_str] = torch.zeros(mem.size()[1:-1], dtype=torch.uint8, device=mem.device)
+        self.pending[mem_str][(slice(None),) + index] = new_mem
+        if self.written[mem_str] is not None:
+            self.written[mem_str][index] = 1
+
+    def detach(self):
+        """Cuts the autograd history of the memories, e.g. between truncated backprop chunks."""
+        self.current = {mem_str: mem.detach() for mem_str, mem in self.current.items()}
+        self.states = [dict(self.current)] if self.keep_states else []
+
+    def commit(self):
+        """Makes this timestep's writes visible; cells that were not written keep their old state."""
+        for mem_str, mem in self.pending.items():
+            written = self.written[mem_str]
+            if written is not None and not written.all():
+                untouched = written == 0
+                mem[:, untouched] = self.current[mem_str][:, untouched]
+            self.current[mem_str] = mem
+        self.pending = {}
+        self.written = {}
+        if self.keep_states:
+            self.states.append(dict(self.current))
@@ -6,12 +6,12 @@ import torch
 # import progressbar
 # from time import sleep
 
-import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 from pathlib import Path
 
-from modules import data
+from modules.trajectory_recorder import DEFAULT_QUEUE_SIZE, get_recorder
+from modules.trajectory_store import TRAJECTORY_FILE_NAME, TrajectoryStore
 
 dict_colors = {'[0.]': 'red', '[1.]': 'green', '[2.]': 'blue'}
 dict_shapes = {'[0.]': 'o', '[1.]': 'v'}
@@ -20,93 +20,58 @@ threshold = 0.05
 ABC = list(string.ascii_uppercase)
 
 
-def save_dataset(file_name, dataset_name, dataset, mode):
-    with h5py.File(file_name, mode) as hf:
-        epoch = len(list(hf.keys()))
-        dataset_name = dataset_name + str(epoch)
-        hf.create_dataset(dataset_name, data=dataset)
-    return epoch
-
-
-def open_dataset(file_name, epoch):
-    try:
-        with h5py.File(file_name, 'r') as hf:
-            inner_file_name = list(hf.keys())[epoch]
-            return np.array(hf[inner_file_name])
-    except Exception as e:
-        print(e)
-
 class Plot:
     def __init__(self, batch_num, total_iteration, num_locations, location_dim, world_dim, num_agents, goals_by_landmark,
-                 folder_dir):
+                 folder_dir, queue_size=DEFAULT_QUEUE_SIZE, drop=False):
         self.batch_num = batch_num
         self.total_iteration = total_iteration + 1
         self.world_dim = world_dim
         self.num_agents = num_agents
-        self.location_matrix = np.zeros(shape=(self.batch_num, self.total_iteration , num_locations, location_dim)) # total_iteration + 1 - so it will include the 'start',
-        self.color_matrix = np.zeros(shape=(self.batch_num, num_locations, 1))
-        self.shape_matrix = np.zeros(shape=(self.batch_num, num_locations, 1))
+        # the detached tensors of every timestep, stacked by the recorder's writer thread
+        self.locations = [] # total_iteration + 1 - so it will include the 'start',
+        self.utterances = {}
         self.goals_by_landmark = goals_by_landmark
+        self.queue_size = queue_size
+        self.drop = drop
         self.filenames(folder_dir)
 
     def filenames(self, folder_dir):
         if not os.path.isabs(folder_dir):
             folder_dir = str(Path(os.getcwd())) + os.sep + folder_dir + os.sep
-        self.location_file_name = folder_dir + 'locations.h5'
-        self.colors_file_name = folder_dir + 'colors.h5'
-        self.shape_file_name = folder_dir + 'shape.h5'
-        self.players_file_name = folder_dir + 'players.h5'
-        self.sentence_file_name = folder_dir + 'sentence.h5'
-        self.goals_by_landmark_file_name = folder_dir + 'goals_by_landmark.h5'
-        self.sentence_file_name_super = folder_dir + 'sentence_super.h5'
+        self.trajectory_file_name = folder_dir + TRAJECTORY_FILE_NAME
 
     def save_utterance_matrix(self, utterance, iteration, mode = None):
-        if mode is None:
-            if iteration == 0:
-                self.utterance_matrix = np.zeros(shape=(self.batch_num, self.total_iteration, self.num_agents, 10))
-            self.utterance_matrix[:,iteration+1, :, :] = utterance.detach().numpy()
-            if iteration == self.total_iteration -2:
-                if os.path.isfile(self.sentence_file_name):
-                    self.save_h5_file('a', utterance='ON')
-                else:
-                    self.save_h5_file('w', utterance='ON')
-        else:
-            if iteration == 0:
-                self.utterance_super_matrix = np.zeros(
-                shape=(self.batch_num, self.total_iteration, self.num_agents, 10))
-            self.utterance_super_matrix[:, iteration+1, :, :] = utterance.detach().numpy()
-            if iteration == self.total_iteration-2:
-                if os.path.isfile(self.sentence_file_name_super):
-                    self.save_h5_file('a', utterance='ON',mode_utter='super')
-                else:
-                    self.save_h5_file('w', utterance='ON',mode_utter='super')
-
-    def save_h5_file(self, mode, utterance=None, mode_utter=None):
-        if utterance is None:
-            save_dataset(self.location_file_name, 'location', self.location_matrix, mode)
-            save_dataset(self.colors_file_name, 'colors', self.color_matrix, mode)
-            save_dataset(self.shape_file_name, 'shape', self.shape_matrix, mode)
-            save_dataset(self.players_file_name, 'players', self.num_agents, mode)
-            save_dataset(self.goals_by_landmark_file_name, 'goals', self.goals_by_landmark, mode)
-        elif utterance is not None and mode_utter is None:
-            save_dataset(self.sentence_file_name, 'sentence', self.utterance_matrix, mode)
-        elif utterance is not None and mode_utter is not None:
-            save_dataset(self.sentence_file_name_super, 'sentence_super', self.utterance_super_matrix, mode)
+        if iteration == 0:
+            # nothing is said at the 'start'
+            self.utterances[mode] = [torch.zeros_like(utterance)]
+        self.utterances[mode].append(utterance.detach())
+
+    def save_h5_file(self, records=None):
+        """Hands the whole played episode, with the given extra records, to the recorder as one item,
+        so that it is written or (when the recorder drops) skipped in every dataset together."""
+        episode = {
+            'location': self.locations,
+            'colors': self.colors,
+            'shape': self.shapes,
+            'players': self.num_agents,
+            'goals': self.goals_by_landmark}
+        if None in self.utterances:
+            episode['sentence'] = self.utterances[None]
+        if 'super' in self.utterances:
+            episode['sentence_super'] = self.utterances['super']
+        episode.update(records or {})
+        get_recorder(self.trajectory_file_name, self.queue_size, self.drop).record_episode(episode)
 
     def save_plot_matrix(self, iteration, locations, colors, shapes):
         if iteration == 'start':
-            self.location_matrix[:,0,:,:] = locations
-            self.color_matrix[:, :, :] = colors
-            self.shape_matrix[:, :, :] = shapes
-
-        elif iteration < self.total_iteration - 2:
-            self.location_matrix[:, iteration + 1, :, :] = locations.detach().numpy()
+            self.locations = [locations.detach()]
+            self.colors = colors
+            self.shapes = shapes
         else:
-            self.location_matrix[:, iteration + 1, :, :] = locations.detach().numpy()
-            if os.path.isfile(self.location_file_name):
-                self.save_h5_file('a')
-            else:
-                self.save_h5_file('w')
+            if iteration == 0:
+                # a game that is played again starts from the same locations
+                self.locations = self.locations[:1]
+            self.locations.append(locations.detach())
 
     @staticmethod
     def create_video(batch_range, epoch_range, folder_dir):
@@ -170,15 +135,18 @@ class Plot:
     def extract_data(epoch, dir=None, calculate_utternace=None,calculate_dist=None):
         #extracting the matrices containing the data from the file
         if dir is None:
-            dir = os.getcwd() + os.sep
-        if calculate_utternace is None and calculate_dist is None:
-            return open_dataset(dir + 'locations.h5', epoch), open_dataset(dir + 'colors.h5', epoch), \
-               open_dataset(dir +'shape.h5', epoch), open_dataset(dir +'players.h5', epoch), \
-               open_dataset(dir +'sentence.h5', epoch), open_dataset(dir +'goals_by_landmark.h5', epoch)
-        elif calculate_utternace is not None:
-            return open_dataset(os.getcwd() + os.sep +'sentence.h5', epoch)
-        elif calculate_dist is not None:
-            return open_dataset(os.getcwd() + os.sep + 'dist_from_goal.h5', epoch)
+            dir = os.getcwd()
+        store = TrajectoryStore(os.path.join(dir, TRAJECTORY_FILE_NAME), 'r')
+        try:
+            if calculate_utternace is None and calculate_dist is None:
+                return store.read('location', epoch), store.read('colors', epoch), store.read('shape', epoch), \
+                       int(store.read('players', epoch)), store.read('sentence', epoch), store.read('goals', epoch)
+            elif calculate_utternace is not None:
+                return store.read('sentence', epoch)
+            elif calculate_dist is not None:
+                return store.read('dist_from_goal', epoch)
+        finally:
+            store.close()
 
     @staticmethod
     def creating_dot_label(entitle, num_agents):
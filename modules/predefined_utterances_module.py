@@ -47,109 +47,133 @@ token_regex = '\w*<(\w*)>\w*'
 tokens = set([re.findall(token_regex,sentence)[i]
           for sentence in sentence_form for i in range(len(re.findall(token_regex,sentence)))])
 
-class PredefinedUtterancesModule:
+# the sentence of the one sentence data set
+one_sentence = ["<agent_color> agent go to <lm_color> landmark"]
+
+
+class SentenceTable(object):
+    """Every sentence of the templates, filled with every agent/landmark color and shape.
+
+    Templates are grouped (see GROUPS); sentence ids run over the groups' templates
+    and, inside a template, over agent color, agent shape, landmark color and
+    landmark shape, so the id of a filled template is computed with array ops and
+    the strings are only looked up when they are needed.
+    """
+    GROUPS = ('goto', 'continue', 'done', 'one_sentence')
+    FIELDS = ('agent_color', 'agent_shape', 'lm_color', 'lm_shape')
+
+    def __init__(self):
+        groups = {'goto': goto_sentences, 'continue': sentence_pool, 'done': done_sentences,
+                  'one_sentence': one_sentence}
+        self.sizes = np.array([len(colors_dict), len(shapes_dict), len(colors_dict), len(shapes_dict)])
+        self.fillings = int(self.sizes.prod())
+        self.group_start = {}
+        self.group_size = {}
+        sentences = []
+        for group in self.GROUPS:
+            self.group_start[group] = len(sentences) // self.fillings
+            self.group_size[group] = len(groups[group])
+            for template in groups[group]:
+                for filling in np.ndindex(*self.sizes):
+                    sentences.append(self.fill(template, dict(zip(self.FIELDS, filling))))
+        self.sentences = np.array(sentences, dtype=object)
 
     @staticmethod
-    def generate_single_sentence(row, iter, one_sentence_mode):
-        row = row
+    def fill(template, filling):
+        sentence = start_token + ' ' + template + ' ' + end_token
+        for token in tokens:
+            if 'color' in token:
+                sentence = sentence.replace('<' + token + '>', colors_dict[filling[token]])
+            elif 'shape' in token:
+                sentence = sentence.replace('<' + token + '>', shapes_dict[filling[token]])
+        return sentence
+
+    def ids(self, groups, fillings):
+        """Sentence ids of a random template of the group (an index into GROUPS) of every row,
+        filled with the rows of fillings [batch_size, 4] (agent color/shape, landmark color/shape)."""
+        starts = np.array([self.group_start[group] for group in self.GROUPS])[groups]
+        sizes = np.array([self.group_size[group] for group in self.GROUPS])[groups]
+        templates = starts + (np.random.rand(len(groups)) * sizes).astype(np.int64)
+        return templates * self.fillings + np.ravel_multi_index(fillings.T, self.sizes)
+
+    def groups(self, dist, iter, one_sentence_mode=False):
+        """The template group of every row: goto at the first timestep or when far from the goal,
+        continue at a middle distance and done when close."""
         if one_sentence_mode:
-            sentence_list = ['Hi ' + colors_dict[int(row['agent_color'])] + ' agent go to ' +
-                             colors_dict[int(row['lm_color'])] + ' landmark <eos>' ]
-            # sentence_list = ['Hi blue agent go to green landmark <eos>']
-                # , 'Hi red agent go to green landmark <eos>','Hi blue agent continue <eos> ']
-            sentence =random.choice(sentence_list)
-            # sentence = 'Hi blue agent go to green landmark <eos>'
-        else:
-            if iter == 0:
-                sentence = random.randint(0, len(goto_sentences) - 1)
-                sentence_ds = goto_sentences
-            elif row['dist'] > 3 and row['dist'] < 7:
-                sentence = random.randint(0, len(sentence_pool) - 1)
-                sentence_ds = sentence_pool
-            elif row['dist'] > 7:
-                sentence = random.randint(0, len(goto_sentences) - 1)
-                sentence_ds = goto_sentences
-            else:
-                sentence = random.randint(0, len(done_sentences) - 1)
-                sentence_ds = done_sentences
-            sentence = start_token + ' ' + sentence_ds[sentence] + ' ' + end_token
-            for token in tokens:
-                if 'color' in token:
-                    sentence = sentence.replace('<' + token + '>', colors_dict[int(row[token])])
-                elif 'shape' in token:
-                    sentence = sentence.replace('<' + token + '>', shapes_dict[int(row[token])])
+            return np.full(len(dist), self.GROUPS.index('one_sentence'))
+        if iter == 0:
+            return np.full(len(dist), self.GROUPS.index('goto'))
+        groups = np.full(len(dist), self.GROUPS.index('done'))
+        groups[(dist > 3) & (dist < 7)] = self.GROUPS.index('continue')
+        groups[dist > 7] = self.GROUPS.index('goto')
+        return groups
 
-        return sentence
+    def decode(self, ids):
+        return self.sentences[ids]
+
+
+class PredefinedUtterancesModule:
+    table = None
+
+    def __init__(self):
+        if PredefinedUtterancesModule.table is None:
+            PredefinedUtterancesModule.table = SentenceTable()
 
     def generate_sentence(self,agent_color, agent_shape, lm_color, lm_shape, dist, iter, df_utterance, mode):
+        fillings = torch.cat((agent_color, agent_shape, lm_color, lm_shape), 1).cpu().numpy().astype(np.int64)
         if iter == 0 or mode !='train_em':
-            data = {'agent_color': torch.Tensor.numpy(agent_color)[:, 0],
-                    'agent_shape': torch.Tensor.numpy(agent_shape)[:, 0],
-                    'lm_color': torch.Tensor.numpy(lm_color)[:, 0],
-                    'lm_shape': torch.Tensor.numpy(lm_shape)[:, 0],
-                    }
-            df_utterance = pd.DataFrame(data=data, dtype=np.int64)
-        df_utterance['dist'] = np.around(dist.detach().numpy(),2)
-        df_utterance['Full Sentence' + str(iter)] = df_utterance.apply(
-            lambda row: PredefinedUtterancesModule.generate_single_sentence(row, iter, self.one_sentence_mode), axis=1, reduce=False )
+            df_utterance = pd.DataFrame(data=fillings, columns=SentenceTable.FIELDS, dtype=np.int64)
+        dist = np.around(dist.detach().cpu().numpy(), 2)
+        df_utterance['dist'] = dist
+        ids = self.table.ids(self.table.groups(dist, iter, self.one_sentence_mode), fillings)
+        df_utterance['Full Sentence' + str(iter)] = self.table.decode(ids)
         return df_utterance
 
     def generate_sentences(self, game, iter, list_df_utterance, one_sentence_mode=False, mode=None): #Todo False
+        """Sentences of every agent of the game; the padded agents of a mixed batch get sentences too (the
+        agents' step reads one per agent), but they are left out of the dataset file."""
         self.one_sentence_mode = one_sentence_mode
         if mode == "train_em":
             dist_from_goal = game.locations[:, :game.num_agents, :] - game.sorted_goals
         elif self.one_sentence_mode:
-            dist_from_goal = torch.ones(size=(game.batch_size,2,2),dtype=torch.float64)
-            dist_from_goal = dist_from_goal.new_full((game.batch_size,2,2),3.141592)
+            dist_from_goal = torch.full((game.batch_size, game.num_agents, 2), 3.141592, dtype=torch.float64)
         else:
-            # TODO: use configs and not hard coded dims
-            rand_agent_locations = torch.FloatTensor(np.random.uniform(low=0, high=16, size=(game.batch_size,2,2)))
+            rand_agent_locations = torch.rand(game.batch_size, game.num_agents, 2) * game.world_dim
             dist_from_goal = rand_agent_locations - game.sorted_goals
-        euclidean_distance = torch.sqrt(torch.sum(torch.pow(dist_from_goal, 2), dim=1))
+        # [batch_size, num_agents]
+        euclidean_distance = torch.sqrt(torch.sum(torch.pow(dist_from_goal, 2), dim=2))
         colors = game.colors
         shapes = game.shapes
+        # colors and shapes of the goal landmark of every agent
+        colors_lm = colors.gather(1, game.goal_entities)
+        shapes_lm = shapes.gather(1, game.goal_entities)
         for i in range(game.num_agents):
-            colors_lm = torch.FloatTensor([colors[btz,game.goal_entities[btz,i]] for btz in range(game.batch_size)]).unsqueeze(1)
-            shape_lm = torch.FloatTensor([shapes[btz,game.goal_entities[btz,i]] for btz in range(game.batch_size)]).unsqueeze(1)
             list_df_utterance[i] = self.generate_sentence(
-                colors[:, i], shapes[:, i], colors_lm,
-                shape_lm, euclidean_distance[:,i], iter, list_df_utterance[i], mode)
-        # list_df_utterance = [self.generate_sentence(
-        #     colors[:, i], shapes[:, i], colors[:, game.goal_entities[:,i,:].squeeze(1),:],
-        #     shapes[:, game.goal_entities[:,i,:].squeeze(1),:], euclidean_distance[:,i], iter, list_df_utterance[i], mode)
-        #     for i in range(game.num_agents)]
+                colors[:, i], shapes[:, i], colors_lm[:, i],
+                shapes_lm[:, i], euclidean_distance[:,i], iter, list_df_utterance[i], mode)
         return list_df_utterance
 
-    def generate_dataset_txt_file(self,btz,df_utterance, df_utterance_col_name):
-        input_regex = ""
-        for index,col_name in enumerate(df_utterance_col_name):
-            input_regex += col_name
-            if index < len(df_utterance_col_name)-1:
-                input_regex += '|'
-            else:
-                pass
-        len_dataset_log = 2 * len(df_utterance[0].columns) + len(df_utterance_col_name)
-        dataset_log = pd.DataFrame(index=range(btz), columns=range(len_dataset_log))
-        col_index = 0
-        dataset_log.loc[:, col_index] = "<input>"
-        col_index += 1
-        for agent in range(len(df_utterance)):
-            dataset_log.loc[:, col_index:col_index+3] = df_utterance[agent].filter(regex=input_regex).values
-            col_index += 4
-        col_index += 1
-        dataset_log.loc[:, col_index-1] = "</input>"
-        dataset_log.loc[:, col_index] = "<dialogue>"
-        col_index += 1
-        len_sentence_iter = 2 * len(df_utterance[0].columns) - 2*len(df_utterance_col_name)
-        for j, i in enumerate(range(0, len_sentence_iter, 2)):
-            dataset_log.loc[:, col_index + i] = df_utterance[0].filter(regex='Full Sentence{0}'.format(j)).values
-            dataset_log.loc[:, col_index + i + 1] = df_utterance[1].filter(regex='Full Sentence{0}'.format(j)).values
-        col_index += len_sentence_iter
-        dataset_log.loc[:, col_index] = "</dialogue>"
-        dataset_log.loc[:, col_index+1] = "<output>"
-        dataset_log.loc[:, col_index+2] = df_utterance[0].filter(regex="dist").values
-        dataset_log.loc[:, col_index+3] = df_utterance[1].filter(regex="dist").values
-        dataset_log.loc[:, col_index+4] = "</output>"
-        # global folder_dir
-        with open("dataset.csv", 'a', newline='') as f:
-            dataset_log.to_csv(f, mode='a', header=False, index=False)
+    def generate_dataset_txt_file(self, btz, df_utterance, df_utterance_col_name, agent_counts=None):
+        """Appends a line for every game to dataset.csv with the inputs of its real agents (agent_counts
+        [btz], by default all of df_utterance), their sentences of every timestep in turn and their
+        distances from the goals. The games are written in groups with the same number of agents."""
+        if agent_counts is None:
+            agent_counts = np.full(btz, len(df_utterance))
+        input_regex = '|'.join(df_utterance_col_name)
+        num_sentences = len(df_utterance[0].filter(regex='Full Sentence').columns)
+        for num_agents in np.unique(agent_counts):
+            rows = np.nonzero(agent_counts == num_agents)[0]
+            agents = [df_utterance[agent].iloc[rows] for agent in range(num_agents)]
+            columns = [["<input>"] * len(rows)]
+            for agent in agents:
+                columns += list(agent.filter(regex=input_regex).values.T)
+            columns += [["</input>"] * len(rows), ["<dialogue>"] * len(rows)]
+            for j in range(num_sentences):
+                columns += [agent['Full Sentence' + str(j)].values for agent in agents]
+            columns += [["</dialogue>"] * len(rows), ["<output>"] * len(rows)]
+            columns += [agent['dist'].values for agent in agents]
+            columns += [["</output>"] * len(rows)]
+            dataset_log = pd.DataFrame({index: list(column) for index, column in enumerate(columns)})
+            # global folder_dir
+            with open("dataset.csv", 'a', newline='') as f:
+                dataset_log.to_csv(f, mode='a', header=False, index=False)
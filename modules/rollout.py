@@ -0,0 +1,68 @@
+import torch
+
+"""
+    The RolloutEngine runs a trained AgentModule over whole games without building
+    autograd graphs. Every timestep is one batched agent step (utterances are the
+    argmax word of each agent), and the trajectory is written into preallocated
+    [time_horizon, batch_size, ...] tensors that are reused between games of the
+    same size instead of a list of per-timestep dicts:
+        -locations: [time_horizon, batch_size, num_entities, 2]
+        -movements: [time_horizon, batch_size, num_entities, 2]
+        -goal_distances: [time_horizon, batch_size, num_agents]
+        -utterances: [time_horizon, batch_size, num_agents, vocab_size] (when using utterances)
+        -costs: [time_horizon]
+    Nothing is written to the plot files.
+"""
+
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+class RolloutEngine(object):
+    def __init__(self, agent):
+        if agent.using_utterances and not agent.use_old_utterance_code:
+            raise ValueError('the rollout engine needs the batched agent step, which the Utterance '
+                             'language model does not support; use the old utterance code')
+        self.agent = agent
+        self.buffers = {}
+
+    def trajectory_buffers(self, game):
+        key = (game.batch_size, game.num_agents, game.num_entities, game.locations.device)
+        if key not in self.buffers:
+            time_horizon = self.agent.time_horizon
+            new = lambda *size: torch.empty(*size, device=game.locations.device)
+            self.buffers[key] = {
+                'locations': new(time_horizon, game.batch_size, game.num_entities, 2),
+                'movements': new(time_horizon, game.batch_size, game.num_entities, self.agent.movement_dim_size),
+                'goal_distances': new(time_horizon, game.batch_size, game.num_agents),
+                'costs': new(time_horizon)}
+            if self.agent.using_utterances:
+                self.buffers[key]['utterances'] = new(time_horizon, game.batch_size, game.num_agents,
+                                                      self.agent.vocab_size)
+        return self.buffers[key]
+
+    def run(self, game):
+        """Plays the game until the time horizon and returns the filled trajectory buffers.
+        The buffers are overwritten by the next game of the same size."""
+        agent = self.agent
+        was_training = agent.training
+        agent.train(False)
+        agent.reset()
+        game.memories.keep_states = False
+        trajectory = self.trajectory_buffers(game)
+        try:
+            with inference_mode():
+                for t in range(agent.time_horizon):
+                    movements = trajectory['movements'][t].zero_()
+                    movements, utterances, goal_predictions = agent.step_batched(game, movements)
+                    game.memories.commit()
+                    cost = game.step(movements, goal_predictions, utterances)
+                    if agent.penalizing_words:
+                        cost = cost + agent.word_counter(utterances)
+                    trajectory['locations'][t] = game.locations
+                    trajectory['goal_distances'][t] = game.get_avg_agent_to_goal_distance()[1]
+                    trajectory['costs'][t] = cost
+                    if agent.using_utterances:
+                        trajectory['utterances'][t] = utterances
+        finally:
+            agent.train(was_training)
+        return trajectory
@@ -0,0 +1,71 @@
+import torch
+
+"""
+    The ScriptedPolicy is a baseline that doesn't communicate and only moves based
+    on its own goal: at every timestep each agent of every game steps straight
+    towards its goal (game.sorted_goals), with every coordinate of the step clipped
+    to [-movement_step_size, movement_step_size] like the movements of the
+    AgentModule. Landmarks and padded agents do not move, no goals are predicted
+    and nothing is said, so a whole batch of games is a handful of tensor ops per
+    timestep without any network.
+    It can be called on a game in place of an AgentModule, returning the total cost
+    and the timesteps, or run like the RolloutEngine, returning the trajectory:
+        -locations: [time_horizon, batch_size, num_entities, 2]
+        -movements: [time_horizon, batch_size, num_entities, 2]
+        -goal_distances: [time_horizon, batch_size, num_agents]
+        -costs: [time_horizon]
+    Games are advanced with game.step, so nothing is written to the plot files.
+    Nothing reads the agent memories either, so games built from
+    ScriptedPolicy.game_config skip allocating them.
+"""
+
+
+class ScriptedPolicy(object):
+    def __init__(self, time_horizon, movement_step_size):
+        self.time_horizon = time_horizon
+        self.movement_step_size = movement_step_size
+
+    @staticmethod
+    def game_config(config):
+        return config._replace(use_utterances=False, memory_size=0)
+
+    def movements(self, game):
+        """The movements of all entities for the current timestep: [batch_size, num_entities, 2]."""
+        movements = torch.zeros_like(game.locations)
+        steps = (game.sorted_goals - game.locations[:, :game.num_agents]).clamp(-self.movement_step_size,
+                                                                                self.movement_step_size)
+        if game.padded:
+            steps = steps.masked_fill(~game.agent_mask.unsqueeze(2), 0)
+        movements[:, :game.num_agents] = steps
+        return movements
+
+    def __call__(self, game):
+        total_cost = 0
+        timesteps = []
+        with torch.no_grad():
+            for t in range(self.time_horizon):
+                movements = self.movements(game)
+                cost = game.step(movements, None, None)
+                total_cost = total_cost + cost
+                timesteps.append({
+                    'locations': game.locations,
+                    'movements': movements,
+                    'loss': cost})
+        return total_cost, timesteps
+
+    def run(self, game):
+        """Plays the game until the time horizon and returns the trajectory."""
+        new = lambda *size: game.locations.new_empty(size)
+        trajectory = {
+            'locations': new(self.time_horizon, game.batch_size, game.num_entities, 2),
+            'movements': new(self.time_horizon, game.batch_size, game.num_entities, 2),
+            'goal_distances': new(self.time_horizon, game.batch_size, game.num_agents),
+            'costs': new(self.time_horizon)}
+        with torch.no_grad():
+            for t in range(self.time_horizon):
+                movements = self.movements(game)
+                trajectory['costs'][t] = game.step(movements, None, None)
+                trajectory['movements'][t] = movements
+                trajectory['locations'][t] = game.locations
+                trajectory['goal_distances'][t] = game.get_avg_agent_to_goal_distance()[1]
+        return trajectory
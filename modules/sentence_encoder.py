@@ -0,0 +1,34 @@
+import torch
+
+"""
+    A SentenceEncoder turns a batch of sentence strings into a padded
+    [batch_size, sentence_length] LongTensor of word indices. The sentences made by
+    the PredefinedUtterancesModule come from a small set (templates x colors x shapes),
+    so every distinct sentence is split, mapped through the dictionary and padded
+    with <pad> only the first time it is seen. It is stored as a row of a table and
+    a batch is then encoded with one index_select over that table.
+"""
+class SentenceEncoder(object):
+    def __init__(self, word_dict, sentence_length):
+        self.word_dict = word_dict
+        self.sentence_length = sentence_length
+        self.pad = word_dict.get_idx('<pad>')
+        self.rows = {}
+        self.new_rows = []
+        self.table = torch.LongTensor(0, sentence_length)
+
+    def row(self, sentence):
+        if sentence not in self.rows:
+            encoded = self.word_dict.w2i(sentence.split(" "))
+            if len(encoded) > self.sentence_length:
+                raise ValueError('sentence "%s" is longer than %d words' % (sentence, self.sentence_length))
+            self.rows[sentence] = len(self.rows)
+            self.new_rows.append(encoded + [self.pad] * (self.sentence_length - len(encoded)))
+        return self.rows[sentence]
+
+    def __call__(self, sentences):
+        rows = torch.LongTensor([self.row(sentence) for sentence in sentences])
+        if self.new_rows:
+            self.table = torch.cat((self.table, torch.LongTensor(self.new_rows)))
+            self.new_rows = []
+        return self.table.index_select(0, rows)
@@ -0,0 +1,117 @@
+import hashlib
+import itertools
+import os
+import re
+
+"""
+    Expansion of the sentence templates ("<agent_color> agent go to <lm_color> landmark")
+    into every sentence they describe. A Template is parsed once into its literal
+    parts and its placeholders; the kind of a placeholder is its name without a
+    prefix and a trailing number (<agent_color>, <color1> and <color2> are colors)
+    and picks the vocabulary it is filled from. The TemplateCompiler enumerates the
+    cartesian product of the vocabularies of each template's own placeholders
+    lazily, so nothing is materialized however large the vocabularies grow, and
+    drops repeated sentences by a 128-bit hash of the sentence, so only the hashes
+    are kept in memory. write_splits streams the sentences into train/val/test files
+    stratified by template: the sentences of every template are dealt in turn over a
+    fixed pattern of splits, each template going on from where the previous one
+    stopped, so every template is split in proportion and the splits are the same
+    on every run.
+"""
+
+PLACEHOLDER_REGEX = re.compile(r'<(\w+)>')
+SPLIT_NAMES = ('train', 'val', 'test')
+# length of the pattern the sentences of a template are dealt into the splits by
+SPLIT_PERIOD = 20
+
+
+def placeholder_kind(name):
+    return re.sub(r'\d+$', '', name).split('_')[-1]
+
+
+def vocabulary(names, size, prefix):
+    """The first size names, extended with prefix0, prefix1, ... when size is larger."""
+    return list(names[:size]) + [prefix + str(i) for i in range(len(names), size)]
+
+
+def split_pattern(valid_fraction, test_fraction, period=SPLIT_PERIOD):
+    num_valid = int(round(valid_fraction * period))
+    num_test = int(round(test_fraction * period))
+    held_out = [1, 2] * min(num_valid, num_test) + [1] * (num_valid - num_test) + [2] * (num_test - num_valid)
+    # the held out positions are spread evenly over the period
+    pattern = [0] * period
+    for k, split in enumerate(held_out):
+        pattern[(k + 1) * period // len(held_out) - 1] = split
+    return pattern
+
+
+class Template(object):
+    def __init__(self, template):
+        self.template = template
+        # the literal text before every placeholder, and after the last one
+        self.parts = PLACEHOLDER_REGEX.split(template)[::2]
+        self.names = PLACEHOLDER_REGEX.findall(template)
+        # the distinct placeholders, in order of appearance
+        self.slots = list(dict.fromkeys(self.names))
+        self.positions = [self.slots.index(name) for name in self.names]
+
+    def fill(self, values):
+        """The sentence with every placeholder replaced by values[placeholder name]."""
+        return self.fill_slots([values[slot] for slot in self.slots])
+
+    def fill_slots(self, slot_values):
+        pieces = [self.parts[0]]
+        for position, part in zip(self.positions, self.parts[1:]):
+            pieces.append(slot_values[position])
+            pieces.append(part)
+        return ''.join(pieces)
+
+    def vocabularies(self, vocabularies):
+        return [vocabularies[placeholder_kind(slot)] for slot in self.slots]
+
+    def size(self, vocabularies):
+        size = 1
+        for values in self.vocabularies(vocabularies):
+            size *= len(values)
+        return size
+
+    def expand(self, vocabularies):
+        for slot_values in itertools.product(*self.vocabularies(vocabularies)):
+            yield self.fill_slots(slot_values)
+
+
+class TemplateCompiler(object):
+    def __init__(self, templates, vocabularies):
+        self.templates = [Template(template) for template in templates]
+        self.vocabularies = vocabularies
+
+    def size(self):
+        """Number of filled templates, before dropping the repeated ones."""
+        return sum(template.size(self.vocabularies) for template in self.templates)
+
+    def expand(self):
+        """Yields (template index, sentence) for every distinct sentence."""
+        seen = set()
+        for i, template in enumerate(self.templates):
+            for sentence in template.expand(self.vocabularies):
+                key = hashlib.blake2b(sentence.encode(), digest_size=16).digest()
+                if key not in seen:
+                    seen.add(key)
+                    yield i, sentence
+
+    def write_splits(self, directory, prefix, valid_fraction, test_fraction):
+        """Writes the sentences to <prefix>_train.txt, <prefix>_val.txt and <prefix>_test.txt,
+        one per line, and returns the number of sentences in every split."""
+        pattern = split_pattern(valid_fraction, test_fraction)
+        counts = [0] * len(SPLIT_NAMES)
+        files = [open(os.path.join(directory, '%s_%s.txt' % (prefix, name)), 'w', buffering=1 << 20)
+                 for name in SPLIT_NAMES]
+        try:
+            for n, (_, sentence) in enumerate(self.expand()):
+                split = pattern[n % len(pattern)]
+                files[split].write(sentence + '\n')
+                counts[split] += 1
+        finally:
+            for f in files:
+                f.close()
+        return counts
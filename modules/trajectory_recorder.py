@@ -0,0 +1,94 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+from modules.trajectory_store import get_store
+
+"""
+    A TrajectoryRecorder takes the records of an episode off the training thread:
+    record_episode only puts the (detached) tensors of the whole episode on a
+    bounded queue as one item, so an episode is kept or dropped as a whole, and a
+    background thread turns them into arrays and appends them to the run's
+    TrajectoryStore, so neither the copies to numpy nor h5py run inside the
+    training step. A record is a tensor, an array or scalar, or a list of
+    per-timestep [batch_size, ...] tensors that is stacked to [batch_size, time, ...].
+    When the queue holds queue_size episodes, record_episode waits for the writer,
+    or with drop it drops the episode and counts it. get_recorder returns one shared
+    recorder per path; all recorders are closed (drained) at exit.
+"""
+
+DEFAULT_QUEUE_SIZE = 16
+
+recorders = {}
+recorders_lock = threading.Lock()
+
+
+def get_recorder(path, queue_size=DEFAULT_QUEUE_SIZE, drop=False):
+    path = os.path.abspath(path)
+    with recorders_lock:
+        if path not in recorders:
+            recorders[path] = TrajectoryRecorder(path, queue_size, drop)
+        return recorders[path]
+
+
+def close_all():
+    with recorders_lock:
+        for recorder in recorders.values():
+            recorder.close()
+        recorders.clear()
+
+
+atexit.register(close_all)
+
+
+def to_array(record):
+    if isinstance(record, (list, tuple)):
+        record = torch.stack(record, 1)
+    if torch.is_tensor(record):
+        return record.detach().cpu().numpy()
+    return np.asarray(record)
+
+
+class TrajectoryRecorder(object):
+    def __init__(self, path, queue_size=DEFAULT_QUEUE_SIZE, drop=False):
+        self.path = path
+        self.drop = drop
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record_episode(self, records):
+        """Hands one episode of every name of the records dict to the writer."""
+        try:
+            self.queue.put(records, block=not self.drop)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        # the store (and its file) is only opened once there is an episode to write
+        store = None
+        while True:
+            records = self.queue.get()
+            if records is None:
+                return
+            try:
+                if store is None:
+                    store = get_store(self.path)
+                store.append_episode({name: to_array(record) for name, record in records.items()})
+            except (IOError, OSError, ValueError, TypeError) as e:
+                logging.warning('recording trajectories to %s failed: %s', self.path, e)
+
+    def close(self):
+        """Writes the queued episodes and stops the writer thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.dropped:
+                logging.warning('%d episodes were dropped by the trajectory recorder of %s', self.dropped, self.path)
@@ -0,0 +1,110 @@
+import atexit
+import os
+import threading
+
+import h5py
+import numpy as np
+
+"""
+    A TrajectoryStore keeps everything a run records per episode (locations,
+    colors, shapes, sentences, distances from the goals, ...) in one HDF5 file that
+    stays open for the whole run. Every record name is one resizable, chunked
+    dataset whose first axis is the episode (one chunk per episode), so appending an
+    episode is one resize and one write, however long the run is. Episodes of
+    different sizes (number of entities or agents) are padded to the largest one so
+    far, growing the dataset when a larger one comes, and the real shape of every
+    episode is kept in a "<name>_shape" dataset so read() returns it unpadded.
+    get_store returns one shared store per path; all stores are closed at exit.
+"""
+
+TRAJECTORY_FILE_NAME = 'trajectories.h5'
+# number of appended episodes between two flushes of the file
+DEFAULT_FLUSH_EVERY = 100
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(path, flush_every=DEFAULT_FLUSH_EVERY):
+    path = os.path.abspath(path)
+    with stores_lock:
+        if path not in stores:
+            stores[path] = TrajectoryStore(path, 'a', flush_every)
+        return stores[path]
+
+
+def close_all():
+    with stores_lock:
+        for store in stores.values():
+            store.close()
+        stores.clear()
+
+
+atexit.register(close_all)
+
+
+class TrajectoryStore(object):
+    def __init__(self, path, mode='a', flush_every=DEFAULT_FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.appends = 0
+        self.lock = threading.Lock()
+        self.file = h5py.File(path, mode)
+
+    def num_episodes(self, name):
+        return self.file[name].shape[0] if name in self.file else 0
+
+    def create(self, name, array):
+        # one chunk per episode, scalars are chunked together
+        chunks = (1,) + tuple(max(size, 1) for size in array.shape) if array.ndim else (1024,)
+        self.file.create_dataset(name, shape=(0,) + array.shape, maxshape=(None,) * (array.ndim + 1),
+                                 chunks=chunks, dtype=array.dtype)
+        if array.ndim:
+            self.file.create_dataset(name + '_shape', shape=(0, array.ndim), maxshape=(None, array.ndim),
+                                     chunks=(1024, array.ndim), dtype=np.int64)
+
+    def append(self, name, array):
+        """Appends the array of one episode to the name dataset and returns its episode index."""
+        array = np.asarray(array)
+        with self.lock:
+            if name not in self.file:
+                self.create(name, array)
+            dataset = self.file[name]
+            episode = dataset.shape[0]
+            dataset.resize((episode + 1,) + tuple(np.maximum(dataset.shape[1:], array.shape)))
+            dataset[(episode,) + tuple(slice(0, size) for size in array.shape)] = array
+            if array.ndim:
+                shapes = self.file[name + '_shape']
+                shapes.resize((episode + 1, array.ndim))
+                shapes[episode] = array.shape
+            self.appends += 1
+            if self.appends % self.flush_every == 0:
+                self.file.flush()
+        return episode
+
+    def append_episode(self, arrays):
+        """Appends one episode of every name of the arrays dict."""
+        for name, array in arrays.items():
+            self.append(name, array)
+
+    def read(self, name, episode):
+        """The array of the episode (negative counts from the end), or None if name was never recorded."""
+        with self.lock:
+            if name not in self.file:
+                return None
+            dataset = self.file[name]
+            episode = range(dataset.shape[0])[episode]
+            if dataset.ndim == 1:
+                return dataset[episode]
+            shape = self.file[name + '_shape'][episode]
+            return dataset[(episode,) + tuple(slice(0, size) for size in shape)]
+
+    def flush(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
@@ -1,16 +1,16 @@
 import os
-import time
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 from torch import optim
-import numpy as np
 from modules.gumbel_softmax import GumbelSoftmax
-from configs import DEFAULT_VOCAB_SIZE
+from configs import DEFAULT_LM_BEST_CHECKPOINT_FILE, DEFAULT_LM_CHECKPOINT_FILE, DEFAULT_VOCAB_SIZE
 import torch.nn.functional as F
 from modules.dialog_model import DialogModel
+from modules.log_sink import get_sink
+from modules.checkpoint import CheckpointManager
 from modules.modules_for_lm import Criterion
+from modules.sentence_encoder import SentenceEncoder
 
 colors_dict = ['red', 'green', 'blue']
 shapes_dict = ['circle', 'triangle']
@@ -50,54 +50,45 @@ class Utterance(nn.Module):
                       [self.lm_model.word_dict.word2idx['blue']],
                       [self.lm_model.word_dict.word2idx['green']]]
         self.crit = Criterion(dataset_dictionary.word_dict, device_id=None, annotation =annotation)
+        self.sentence_encoder = SentenceEncoder(dataset_dictionary.word_dict, DEFAULT_VOCAB_SIZE)
         # self.crit = Criterion(dataset_dictionary.word_dict, device_id=None)
 
         self.opt = optim.Adam(self.lm_model.parameters(), lr=utterance_config.lr)
         self.config = utterance_config
+        self.lm_steps = 0
+        self.checkpoints = CheckpointManager(os.path.join(utterance_config.folder_dir, DEFAULT_LM_CHECKPOINT_FILE),
+                                             utterance_config.lm_checkpoint_interval,
+                                             os.path.join(utterance_config.folder_dir, DEFAULT_LM_BEST_CHECKPOINT_FILE))
         # self.loss = torch.zeros(size=(1,))
 
     def forward(self, processed, full_sentence, step=None, epoch=None):
         self.loss = torch.zeros(size=(1,))
         self.words = torch.LongTensor(size=[self.config.batch_size, DEFAULT_VOCAB_SIZE])
         self.lang_h = self.lm_model.zero_hid(processed.size(0), self.lm_model.config.nhid_lang)
-        utter = full_sentence.tolist()
-        encoded_utter = [self.dataset_dictionary.word_dict.w2i(utter[i].split(" "))
-                         for i in range(len(full_sentence))]
-        encoded_pad = self.dataset_dictionary.word_dict.w2i(['<pad>'])
-        longest_sentence = DEFAULT_VOCAB_SIZE
-        encoded_utter = [encoded_utter[i] + encoded_pad * (longest_sentence - len(encoded_utter[i]))
-                         if len(encoded_utter[i]) < longest_sentence else encoded_utter[i]
-                         for i in range(len(full_sentence))]
-        encoded_utter = Variable(torch.LongTensor(np.array(encoded_utter)))
+        encoded_utter = self.sentence_encoder(full_sentence.tolist())
         encoded_utter_out = encoded_utter
         encoded_utter = encoded_utter.transpose(0, 1)
         encoded_utter = encoded_utter.contiguous()
         inpt = encoded_utter.narrow(0, 0, encoded_utter.size(0) - 1)
+        self.inpt = inpt
         self.tgt = encoded_utter.narrow(0, 1, encoded_utter.size(0) - 1).view(-1)
 
         if self.action_processor_config.mode == 'train_utter':
             out, lang_h = self.lm_model.forward_lm(inpt, self.lang_h, processed.unsqueeze(0))
             loss = self.crit(out.view(-1, len(self.dataset_dictionary.word_dict)), self.tgt)
-            # decode utterance (for plot and for us)
-            # try 1 with for loop
-            for batch in range(self.config.batch_size):
-                self.words[batch, 0] = self.lm_model.word2var('Hi').unsqueeze(1)
-                for word_idx in range(0, DEFAULT_VOCAB_SIZE - 1):  # with out the Hi
-                    scores = out[word_idx, batch].add(-out[word_idx, batch].max().item())
-                    prob = F.softmax(scores, dim=0)
-                    word = prob.multinomial(num_samples=1).detach()
-                    self.words[batch, word_idx + 1] = word
+            # decode utterance (for plot and for us): sample every word of the batch at once
+            prob = F.softmax(out.detach(), dim=2)
+            words = prob.view(-1, prob.size(2)).multinomial(num_samples=1).view(out.size(0), out.size(1))
+            self.words[:, 0] = self.lm_model.word_dict.get_idx('Hi')
+            self.words[:, 1:] = words.t()
         else:
             # create initial hidden state for the language rnn and self_words
             self.lang_hs = []
             self.write(self.lang_h, processed.unsqueeze(0)) #undecoded utter, to decode it use: self._decode(utter, self.lm_model.word_dict)
-        utter_print = '' ##remove
-        utter_print = self.lm_model.word_dict.i2w(self.words[1].data.cpu()) # [str(self.total_loss)]
-        utter_print = ' '.join(utter_print)
         if self.action_processor_config.mode == 'train_utter':
-            with open(self.config.folder_dir+os.sep+"utterance_out_fb.csv", 'a', newline='') as f:
-                f.write(utter_print)
-                # f.write('\n')
+            log = get_sink(self.config.folder_dir+os.sep+"utterance_out_fb.csv", self.config.log_every)
+            if log.sampled(epoch):
+                log.write(' '.join(self.lm_model.word_dict.i2w(self.words[1].data.cpu())))
             if epoch == 100:
                 for param_group in self.opt.param_groups:
                     param_group['lr'] = 0.000001
@@ -108,14 +99,15 @@ class Utterance(nn.Module):
             torch.nn.utils.clip_grad_norm_(self.lm_model.parameters(),
                                            self.config.clip)
             self.opt.step()
-            with open(self.config.folder_dir+os.sep+'lm_model.pt', 'wb') as f:
-                torch.save(self.lm_model.state_dict(), f)
-            print(loss, epoch)
+            self.lm_steps += 1
+            self.checkpoints.step(self.lm_model, self.lm_steps, loss.item())
+            if log.sampled(epoch):
+                print(loss, epoch)
             return loss, self.words , self.config.folder_dir
         else:
-            with open(self.config.folder_dir+os.sep+"utterance_out_fine_tune.csv", 'a', newline='') as f:
-                f.write(utter_print)
-                f.write('\n')
+            log = get_sink(self.config.folder_dir+os.sep+"utterance_out_fine_tune.csv", self.config.log_every)
+            if log.sampled(epoch):
+                log.write(' '.join(self.lm_model.word_dict.i2w(self.words[1].data.cpu())) + '\n')
             self.opt.zero_grad()
             # print(self.total_loss)
             # print(self.dataset_dictionary.word_dict.i2w(word[1, :]))
@@ -126,19 +118,18 @@ class Utterance(nn.Module):
         if training:
             utterance = self.gumbel_softmax(utter)
         else:
-            utterance = torch.zeros(utter.size())
-            if self.using_cuda:
-                utterance = utterance.cuda()
-            max_utter = utter.max(1)[1]
-            max_utter = max_utter.data[0]
-            utterance[0, max_utter] = 1
+            # one-hot of the most likely word for every row of the batch
+            utterance = torch.zeros_like(utter).scatter_(1, utter.max(1)[1].unsqueeze(1), 1)
         return utterance
 
     def write(self, lang_h, processed):
         # generate a new utterance #todo Start HERE!
         self.lang_h = lang_h
-        outs, self.lang_h, lang_hs, self.loss = self.lm_model.write(self.lang_h, processed, DEFAULT_VOCAB_SIZE-1 ,
-                                                               self.config.temperature, self.loss, self.tgt)
+        outs, self.lang_h, lang_hs = self.lm_model.write(self.lang_h, processed, DEFAULT_VOCAB_SIZE-1,
+                                                         self.config.temperature, self.tgt)
+        if self.action_processor_config.mode == 'train_em':
+            # the words of the target are fed while writing, so the loss is computed in one teacher-forced pass
+            self.loss = self.lm_model.teacher_forced_loss(self.inpt, self.tgt, lang_h, processed)
         # if self.step == 0:
         #     self.total_loss = self.crit(scores.view(-1, len(self.dataset_dictionary.word_dict.idx2word)), self.tgt)
         #     # print(id(scores))
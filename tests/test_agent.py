@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+import configs
+from modules import data, trajectory_recorder, trajectory_store
+from modules.agent import AgentModule
+from modules.game import GameModule
+from modules.predefined_utterances_module import SentenceTable
+from train import parser
+
+
+def make_corpus(path):
+    """A corpus whose dictionary holds every predefined sentence."""
+    sentences = ' '.join(SentenceTable().sentences.tolist())
+    line = '<input> 0 1 0 0 2 0 0 0 </input> <dialogue> %s </dialogue> <output> 1.5 2.5 </output>\n' % sentences
+    for name in ('train', 'val', 'test'):
+        with open(os.path.join(path, 'dataset_%s.txt' % name), 'w') as f:
+            f.write(line)
+    return data.WordCorpus(path, freq_cutoff=0)
+
+
+class AgentModuleTest(unittest.TestCase):
+    def setUp(self):
+        self.folder_dir = tempfile.mkdtemp() + os.sep
+        self.cwd = os.getcwd()
+        # the dataset mode appends the games to dataset.csv in the working dir
+        os.chdir(self.folder_dir)
+        self.corpus = make_corpus(self.folder_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        trajectory_recorder.close_all()
+        trajectory_store.close_all()
+        shutil.rmtree(self.folder_dir)
+
+    def configs(self, *argv):
+        args = vars(parser.parse_args(['--batch-size', '6', '-t', '3', '--max-agents', '3', '--max-landmarks', '3']
+                                      + list(argv)))
+        return configs.get_game_config(args), configs.get_agent_config(args)
+
+    def padded_game(self, game_config):
+        torch.manual_seed(0)
+        return GameModule(game_config, torch.LongTensor([1, 2, 3, 3, 2, 1]), torch.LongTensor([3, 1, 2, 3, 2, 1]),
+                          self.folder_dir)
+
+    def test_dataset_mode_on_a_padded_batch(self):
+        game_config, agent_config = self.configs('--no-utterances')
+        agent = AgentModule(agent_config, configs.get_utterance_config(), self.corpus, True, True)
+        game = self.padded_game(game_config)
+        self.assertTrue(game.padded)
+        total_cost, _ = agent(game)
+        self.assertTrue(torch.isfinite(total_cost).all())
+
+        # every game is written with its own agents only
+        with open('dataset.csv') as f:
+            lines = [line.strip().split(',') for line in f]
+        self.assertEqual(len(lines), game.batch_size)
+        agent_counts = sorted((line.index('</input>') - 1) // len(SentenceTable.FIELDS) for line in lines)
+        self.assertEqual(agent_counts, sorted(game.agent_counts.tolist()))
+        for line in lines:
+            num_agents = (line.index('</input>') - 1) // len(SentenceTable.FIELDS)
+            dialogue = line[line.index('<dialogue>') + 1:line.index('</dialogue>')]
+            output = line[line.index('<output>') + 1:line.index('</output>')]
+            self.assertEqual(len(dialogue), num_agents * game.time_horizon)
+            self.assertEqual(len(output), num_agents)
+
+    def play(self, agent, game_config, padded):
+        torch.manual_seed(1)
+        if padded:
+            game = self.padded_game(game_config)
+        else:
+            game = GameModule(game_config, 2, 3, self.folder_dir)
+        with torch.no_grad():
+            total_cost, _ = agent(game)
+        return total_cost, game
+
+    def assert_batched_step_matches_loop(self, padded):
+        game_config, agent_config = self.configs()
+        looped = AgentModule(agent_config, configs.get_utterance_config(), self.corpus, False, True)
+        batched = AgentModule(agent_config._replace(batched_step=True), configs.get_utterance_config(), self.corpus,
+                              False, True)
+        batched.load_state_dict(looped.state_dict())
+        looped.eval()
+        batched.eval()
+        self.assertTrue(batched.can_batch_step() and not looped.can_batch_step())
+        looped_cost, looped_game = self.play(looped, game_config, padded)
+        batched_cost, batched_game = self.play(batched, game_config, padded)
+        self.assertEqual(looped_game.padded, padded)
+        torch.testing.assert_close(batched_cost, looped_cost, rtol=1e-4, atol=1e-3)
+        torch.testing.assert_close(batched_game.locations, looped_game.locations, rtol=1e-4, atol=1e-4)
+        for name in ('physical', 'utterance', 'action'):
+            torch.testing.assert_close(batched_game.memories[name], looped_game.memories[name], rtol=1e-4, atol=1e-4,
+                                       msg=name)
+
+    def test_batched_step_matches_loop(self):
+        self.assert_batched_step_matches_loop(False)
+
+    def test_batched_step_matches_loop_on_a_padded_batch(self):
+        self.assert_batched_step_matches_loop(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+import torch
+
+from modules.game_step import GameStep
+
+
+class GameStepTest(unittest.TestCase):
+    batch_size = 3
+    num_agents = 3
+    num_entities = 5
+
+    def inputs(self, with_predictions, padded):
+        torch.manual_seed(0)
+        a, e = self.num_agents, self.num_entities
+        locations = torch.rand(self.batch_size, e, 2, dtype=torch.double, requires_grad=True)
+        movements = torch.rand(self.batch_size, e, 2, dtype=torch.double, requires_grad=True)
+        goals = torch.cat((torch.rand(self.batch_size, a, 2, dtype=torch.double),
+                           torch.randint(a, (self.batch_size, a, 1)).double()), 2)
+        sorted_goals = torch.rand(self.batch_size, a, 2, dtype=torch.double)
+        goal_predictions = None
+        if with_predictions:
+            goal_predictions = torch.rand(self.batch_size, a, a, 3, dtype=torch.double, requires_grad=True)
+        agent_mask = agent_pair_mask = None
+        if padded:
+            agent_mask = torch.arange(a).unsqueeze(0) < torch.LongTensor([1, 2, 3]).unsqueeze(1)
+            agent_pair_mask = agent_mask.unsqueeze(2) & agent_mask.unsqueeze(1)
+        return locations, movements, goals, sorted_goals, goal_predictions, agent_mask, agent_pair_mask
+
+    def assert_gradcheck(self, with_predictions, padded):
+        self.assertTrue(torch.autograd.gradcheck(GameStep.apply, self.inputs(with_predictions, padded)))
+
+    def test_gradcheck(self):
+        self.assert_gradcheck(True, False)
+
+    def test_gradcheck_with_masked_agents(self):
+        self.assert_gradcheck(True, True)
+
+    def test_gradcheck_without_goal_predictions(self):
+        self.assert_gradcheck(False, False)
+
+    def test_gradcheck_with_masked_agents_without_goal_predictions(self):
+        self.assert_gradcheck(False, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
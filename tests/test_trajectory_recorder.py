@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import torch
+
+import configs
+from modules import trajectory_recorder, trajectory_store
+from modules.game import GameModule
+from modules.plot import Plot
+
+
+class TrajectoryRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder_dir = tempfile.mkdtemp() + os.sep
+        self.path = self.folder_dir + trajectory_store.TRAJECTORY_FILE_NAME
+        self.game_config = configs.default_game_config._replace(batch_size=4, time_horizon=3, memory_size=4,
+                                                                vocab_size=10, use_utterances=True,
+                                                                trajectory_queue_size=1, drop_trajectories=True)
+
+    def tearDown(self):
+        trajectory_recorder.close_all()
+        trajectory_store.close_all()
+        shutil.rmtree(self.folder_dir)
+
+    def play(self, num_agents, num_landmarks):
+        game = GameModule(self.game_config, num_agents, num_landmarks, self.folder_dir)
+        for t in range(game.time_horizon):
+            utterances = torch.rand(game.batch_size, game.num_agents, self.game_config.vocab_size)
+            game(torch.randn(game.batch_size, game.num_entities, 2), None, utterances, t, utterances)
+        game.save_trajectory({'dist_from_goal': game.get_avg_agent_to_goal_distance()[1]})
+
+    def test_dropped_episodes_keep_the_datasets_aligned(self):
+        # hold the writer on the first episode so that the queue fills up and episodes are dropped
+        store = trajectory_store.get_store(self.path)
+        release = threading.Event()
+        append_episode = store.append_episode
+
+        def held_append_episode(arrays):
+            release.wait()
+            append_episode(arrays)
+        store.append_episode = held_append_episode
+        recorder = trajectory_recorder.get_recorder(self.path, self.game_config.trajectory_queue_size,
+                                                    self.game_config.drop_trajectories)
+        num_episodes = 10
+        for episode in range(num_episodes):
+            self.play(2, 1 + episode % 3)
+        release.set()
+        recorder.close()
+        self.assertGreater(recorder.dropped, 0)
+
+        names = ['location', 'colors', 'shape', 'players', 'goals', 'sentence', 'sentence_super', 'dist_from_goal']
+        lengths = {name: store.num_episodes(name) for name in names}
+        self.assertEqual(len(set(lengths.values())), 1, lengths)
+        self.assertEqual(lengths['location'] + recorder.dropped, num_episodes)
+
+    def test_no_file_without_episodes(self):
+        trajectory_recorder.get_recorder(self.path).close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_episodes_read_back(self):
+        self.game_config = self.game_config._replace(drop_trajectories=False)
+        recorder = trajectory_recorder.get_recorder(self.path, 1, False)
+        for episode in range(3):
+            self.play(1 + episode % 2, 2)
+        recorder.close()
+        trajectory_store.close_all()
+        locations, colors, shapes, players, sentences, goals = Plot.extract_data(2, dir=self.folder_dir)
+        self.assertEqual(locations.shape, (4, 4, 3, 2))
+        self.assertEqual(sentences.shape, (4, 4, 1, 10))
+        self.assertEqual(players, 1)
+        self.assertEqual(Plot.extract_data(2, dir=self.folder_dir, calculate_dist='ON').shape, (4, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
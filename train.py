@@ -4,9 +4,10 @@ from collections import defaultdict
 
 import numpy as np
 import torch
-from modules import plot
 from modules.agent import AgentModule
 from modules.game import GameModule
+from modules.trajectory_recorder import get_recorder
+from modules.trajectory_store import TRAJECTORY_FILE_NAME
 from tensorboardX import SummaryWriter  # the tensorboardX is installed in the anaconda console
 from torch.optim import RMSprop
 from torch.optim.lr_scheduler import ReduceLROnPlateau
@@ -40,7 +41,26 @@ parser.add_argument('--creating-data-set-mode', required=False, type=bool, help=
 parser.add_argument('--create-utterance-using-old-code', type=bool, help='use when we want to create dataset, or create the trained model that the dataset code willuse ')
 parser.add_argument('--one-sentence-data-set', action='store_true', default=False, help='temp, train the mini FC network on one setuation')
 parser.add_argument('--fb-dir', required=False, type=str, help='if specified FB will be fine tuned ussing the reward loss, the fb model weight will be taken from the specifed dir')
-parser.add_argument('--mode', required=False, type=str, help='selfplay/train_em/train_utter')
+parser.add_argument('--mode', required=False, type=str, help='selfplay/train_em/train_utter/pretrain_lm')
+parser.add_argument('--mixed-game-sizes', action='store_true', default=False, help='if specified every batch mixes games with different numbers of agents and landmarks, padded to the maximum (default disabled)')
+parser.add_argument('--fused-game-step', action='store_true', default=False, help='if specified runs the game dynamics and cost of a timestep as one fused autograd node (default disabled)')
+parser.add_argument('--truncated-bptt-steps', type=int, help='if specified backpropagates every k timesteps and carries detached memories between chunks (default disabled)')
+parser.add_argument('--checkpoint-timesteps', action='store_true', default=False, help='if specified recomputes the activations of each batched timestep during backward instead of storing them (default disabled)')
+parser.add_argument('--compile-agent-step', action='store_true', default=False, help='if specified compiles the per-timestep agent processing with torch.compile, falling back to eager mode if compiling fails (default disabled)')
+parser.add_argument('--compile-cache-dir', type=str, help='if specified keeps the compiled kernels in this directory between runs (default .compile_cache in the working dir)')
+parser.add_argument('--eval-games', type=int, help='number of games evaluate.py plays with the loaded weights (default one batch); evaluate.py needs --no-utterances or --create-utterance-using-old-code True, as the Utterance language model does not support its batched rollouts')
+parser.add_argument('--scripted-policy', action='store_true', default=False, help='if specified evaluate.py plays the games with the scripted policy that moves every agent straight to its goal instead of the loaded weights (default disabled)')
+parser.add_argument('--lm-batch-size', type=int, help='batch size of the corpus batches in pretrain_lm mode of train_utter.py (default 256)')
+parser.add_argument('--utterance-log-every', type=int, help='only every n-th batch is written to the utterance logs and printed by train_utter.py (default 1)')
+parser.add_argument('--lm-checkpoint-interval', type=int, help='number of language model steps between the checkpoints of train_utter.py (default 100)')
+parser.add_argument('--lm-valid-interval', type=int, help='number of steps between validations in pretrain_lm mode of train_utter.py (default 200)')
+parser.add_argument('--num-dialogues', type=int, help='number of dialogues generate_corpus.py writes (default one batch)')
+parser.add_argument('--num-workers', type=int, help='number of worker processes of generate_corpus.py (default the number of CPUs)')
+parser.add_argument('--dataset-dir', type=str, help='directory generate_corpus.py writes the dataset files to (default data)')
+parser.add_argument('--dataset-seed', type=int, help='seed of the first shard of generate_corpus.py, shard i uses seed + i (default 0)')
+parser.add_argument('--trajectory-queue-size', type=int, help='number of episodes the trajectory recorder holds before the game waits for the writer or drops them (default 16)')
+parser.add_argument('--drop-trajectories', action='store_true', default=False, help='if specified the trajectory recorder drops episodes when its queue is full instead of waiting for the writer (default disabled)')
+parser.add_argument('--batched-step', action='store_true', default=False, help='if specified runs all agents of a timestep in a few batched calls instead of looping over agents and entities (default disabled)')
 
 
 def print_losses(epoch, losses, dists, game_config, writer):
@@ -63,13 +83,15 @@ def main():
     agent_config = configs.get_agent_config(args)
     game_config = configs.get_game_config(args)
     training_config = configs.get_training_config(args, run_config.folder_dir)
-    utterance_config = configs.get_utterance_config()
+    utterance_config = configs.get_utterance_config(args)
     print("Training with config:")
     print(training_config)
     print(game_config)
     print(agent_config)
     print(run_config)
     writer = SummaryWriter(run_config.folder_dir + 'tensorboard' + os.sep)  #Tensorboard - setting where the temp files will be saved
+    trajectories = get_recorder(run_config.folder_dir + TRAJECTORY_FILE_NAME, game_config.trajectory_queue_size,
+                                game_config.drop_trajectories)
     agent = AgentModule(agent_config, utterance_config, run_config.corpus, run_config.creating_data_set_mode, run_config.create_utterance_using_old_code)
     if run_config.upload_trained_model:
         folder_dir_trained_model = run_config.dir_upload_model
@@ -90,7 +112,15 @@ def main():
         game_init = GameModule(game_config, num_agents, num_landmarks, run_config.folder_dir)
 
     for epoch in range(training_config.num_epochs):
-        if args['one_sentence_data_set'] == False:
+        if args['mixed_game_sizes']:
+            agent.reset()
+            game = GameModule(game_config,
+                              torch.randint(game_config.min_agents, game_config.max_agents + 1, (game_config.batch_size,)),
+                              torch.randint(game_config.min_landmarks, game_config.max_landmarks + 1, (game_config.batch_size,)),
+                              run_config.folder_dir)
+            # a mixed batch is logged under the largest configuration it holds
+            num_agents, num_landmarks = game.num_agents, game.num_landmarks
+        elif args['one_sentence_data_set'] == False:
             num_agents = np.random.randint(game_config.min_agents, game_config.max_agents+1)
             num_landmarks = np.random.randint(game_config.min_landmarks, game_config.max_landmarks+1)
             agent.reset()
@@ -103,22 +133,20 @@ def main():
         optimizer.zero_grad()
 
         total_loss, _ = agent(game)
-        per_agent_loss = total_loss.data[0] / num_agents / game_config.batch_size
+        num_agent_games = game.agent_counts.sum().item()
+        per_agent_loss = total_loss.data[0] / num_agent_games
         losses[num_agents][num_landmarks].append(per_agent_loss)
 
         dist, dist_per_agent = game.get_avg_agent_to_goal_distance() #add to tensorboard
-        dist_per_agent_file_name = run_config.folder_dir + 'dist_from_goal.h5'
-        if os.path.isfile(dist_per_agent_file_name):
-            plot.save_dataset(dist_per_agent_file_name, 'dist_from_goal', dist_per_agent.detach().numpy(), 'a')
-        else:
-            plot.save_dataset(dist_per_agent_file_name, 'dist_from_goal', dist_per_agent.detach().numpy(), 'w')
+        game.save_trajectory({'dist_from_goal': dist_per_agent.detach()})
 
-        avg_dist = dist.data.item() / num_agents / game_config.batch_size
+        avg_dist = dist.data.item() / num_agent_games
         dists[num_agents][num_landmarks].append(avg_dist)
 
         print_losses(epoch, losses, dists, game_config, writer)
         torch.autograd.set_detect_anomaly(True)
-        total_loss.backward()
+        if not agent.truncating_bptt():
+            total_loss.backward()
         optimizer.step()
         optimizer.zero_grad()
 
@@ -128,6 +156,7 @@ def main():
     torch.save(agent.state_dict(), training_config.save_model_file)
     print("Saved agent model weights at %s" % training_config.save_model_file)
     writer.close() # close the tensorboard temp files
+    trajectories.close()
 
     """
     import code
@@ -7,10 +7,13 @@ import torch
 from torch.autograd import Variable
 
 import configs
-from modules import data, action
 from modules.action import ActionModule
 from modules.agent import AgentModule
+from modules.data import UNKNOWN_IDX
+from modules.dialogue_contexts import FIELDS_PER_AGENT, DialogueContexts, input_signatures
 from modules.game import GameModule
+from modules.lm_evaluator import LMEvaluator
+from modules.log_sink import get_sink, close_all
 from modules.predefined_utterances_module import PredefinedUtterancesModule
 from modules.utterance import Utterance
 from train import parser
@@ -19,6 +22,78 @@ from train import parser
 colors_dict = ['red', 'green', 'blue']
 shapes_dict = ['circle', 'triangle']
 
+
+def dialogue_contexts(agent, action, agent_config, corpus, game_config, folder_dir):
+    """The context vectors of the corpus dialogues. For every distinct input a game is built whose agents
+    have the colors and shapes of the input and whose agent a goes to landmark num_agents + a, which has the
+    color and shape of its goal; the processed features of the game's agents, averaged over the agents,
+    are the context of the input. Inputs that do not list whole agents get a zero context."""
+    signatures, lengths = input_signatures(corpus)
+    values = np.array([int(word) if word.isdigit() else -1 for word in corpus.context_dict.idx2word])
+    whole = (lengths > 0) & (lengths % FIELDS_PER_AGENT == 0) & (signatures != UNKNOWN_IDX).all(1)
+    rows, contexts = [], []
+    with torch.no_grad():
+        for length in np.unique(lengths[whole]):
+            group = np.nonzero(whole & (lengths == length))[0]
+            attributes = values[signatures[group, :length]]
+            group, attributes = group[(attributes >= 0).all(1)], attributes[(attributes >= 0).all(1)]
+            if not len(group):
+                continue
+            num_agents = int(length) // FIELDS_PER_AGENT
+            # [len(group), num_agents, 4]: agent color, agent shape, goal landmark color and shape
+            attributes = torch.from_numpy(attributes).view(len(group), num_agents, FIELDS_PER_AGENT).float()
+            colors = torch.cat((attributes[:, :, 0], attributes[:, :, 2]), 1).unsqueeze(2)
+            shapes = torch.cat((attributes[:, :, 1], attributes[:, :, 3]), 1).unsqueeze(2)
+            goal_agents = torch.arange(num_agents).view(1, -1, 1).expand(len(group), -1, -1)
+            game = GameModule(game_config._replace(batch_size=len(group)), num_agents, num_agents, folder_dir,
+                              colors, shapes, goal_agents, goal_agents + num_agents)
+            processed = []
+            for agent_num in range(num_agents):
+                physical_feat = agent.get_physical_feat(game, agent_num)
+                mem = torch.zeros(game.batch_size, game_config.memory_size)
+                utterance_feat = torch.zeros([game.batch_size, 1, agent_config.action_processor.hidden_size],
+                                             dtype=torch.float)
+                processed.append(action.processed_data(physical_feat, game.observed_goals[:, agent_num], mem,
+                                                       utterance_feat)[0])
+            rows.append(torch.from_numpy(group))
+            contexts.append(torch.stack(processed).mean(0))
+    table = torch.zeros(len(signatures), contexts[0].size(1))
+    table[torch.cat(rows)] = torch.cat(contexts)
+    return DialogueContexts(torch.from_numpy(signatures), table, len(corpus.context_dict))
+
+
+def pretrain_lm(utter, corpus, contexts, utterance_config, training_config):
+    """Trains the language model of utter with forward_lm straight from the corpus batches,
+    validating snapshots of it in a worker process."""
+    model = utter.lm_model
+    model.train()
+    evaluator = LMEvaluator(corpus, utterance_config, contexts, utterance_config.lm_batch_size)
+    snapshots = {}
+
+    def report(results):
+        for step, dataset, loss, perplexity in results:
+            print("[step %d][%s loss: %f][%s perplexity: %f]" % (step, dataset, loss, dataset, perplexity))
+            utter.checkpoints.best(snapshots.pop(step), loss)
+
+    for epoch in range(training_config.num_epochs):
+        for ctx, inpt, tgt, _ in corpus.stream_dataset('train', utterance_config.lm_batch_size):
+            loss = model.teacher_forced_loss(inpt, tgt, model.zero_hid(inpt.size(1)), contexts(ctx))
+            utter.opt.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), utterance_config.clip)
+            utter.opt.step()
+            utter.lm_steps += 1
+            if utter.lm_steps % utterance_config.lm_valid_interval == 0:
+                print("[epoch %d][step %d][train loss: %f]" % (epoch, utter.lm_steps, loss.item()))
+                snapshots[utter.lm_steps] = utter.checkpoints.snapshot(model)
+                evaluator.submit(snapshots[utter.lm_steps], utter.lm_steps)
+            utter.checkpoints.step(model, utter.lm_steps)
+            report(evaluator.results())
+    report(evaluator.close())
+    utter.checkpoints.step(model, utter.lm_steps, force=True)
+    utter.checkpoints.close()
+
+
 def main():
     args = vars(parser.parse_args())
     mode = args['mode']
@@ -31,17 +106,21 @@ def main():
     folder_dir = run_default_config.folder_dir
     agent_config = configs.get_agent_config(args)
     game_config = configs.get_game_config(args)
-    utterance_config = configs.get_utterance_config()
+    utterance_config = configs.get_utterance_config(args)
     training_config = configs.get_training_config(args, folder_dir)
-    corpus = data.WordCorpus('data' + os.sep, freq_cutoff=20, verbose=True)
+    corpus = run_default_config.corpus
     agent = AgentModule(agent_config, utterance_config, corpus, run_default_config.creating_data_set_mode,
                         run_default_config.create_utterance_using_old_code)
     utter = Utterance(agent_config.action_processor, utterance_config, corpus, run_default_config.create_utterance_using_old_code)
-    if not mode == "train_utter":
+    if mode not in ("train_utter", "pretrain_lm"):
         folder_dir_fb_model = utterance_config.fb_dir
         with open(folder_dir_fb_model, 'rb') as f:
             utter.load_state_dict(torch.load(f))
     action = ActionModule(agent_config.action_processor, utterance_config, corpus, run_default_config.create_utterance_using_old_code)
+    if mode == "pretrain_lm":
+        contexts = dialogue_contexts(agent, action, agent_config, corpus, game_config, folder_dir)
+        pretrain_lm(utter, corpus, contexts, utterance_config, training_config)
+        return
     create_data_set = PredefinedUtterancesModule()
     if one_sentence_mode:
         num_agents = np.random.randint(game_config.min_agents,
@@ -81,27 +160,28 @@ def main():
 
         if selfplay:
             loss, utterance, _ = utter(processed, full_sentence, epoch=epoch)
-            with open(folder_dir + os.sep + "utterance_selfplay_annotation.csv", 'a', newline='') as f:
-                for index in range(len(utterance)):
-                    f.write(' '.join(corpus.word_dict.i2w(utterance[index].data.cpu())))
-                    f.write(" " + 'agent_color' + " " + colors_dict[df_utterance[agent_num]['agent_color'][index]])
-                    f.write(" " + 'agent_shape' + " " + shapes_dict[df_utterance[agent_num]['agent_shape'][index]])
-                    f.write(" " + 'lm_color' + " " + colors_dict[df_utterance[agent_num]['lm_color'][index]])
-                    f.write(" " + 'lm_shape' + " " + shapes_dict[df_utterance[agent_num]['lm_shape'][index]])
-                    f.write('\n')
+            log = get_sink(folder_dir + os.sep + "utterance_selfplay_annotation.csv", utterance_config.log_every)
+            if log.sampled(epoch):
+                df = df_utterance[agent_num]
+                log.write(''.join(
+                    ' '.join(corpus.word_dict.i2w(utterance[index].data.cpu()))
+                    + " " + 'agent_color' + " " + colors_dict[df['agent_color'][index]]
+                    + " " + 'agent_shape' + " " + shapes_dict[df['agent_shape'][index]]
+                    + " " + 'lm_color' + " " + colors_dict[df['lm_color'][index]]
+                    + " " + 'lm_shape' + " " + shapes_dict[df['lm_shape'][index]] + '\n'
+                    for index in range(len(utterance))))
         else:
             loss, utterance, folder_dir = utter(processed, full_sentence, epoch=epoch)
-            with open(folder_dir + os.sep + "utterance_out_fb.csv", 'a', newline='') as f:
-                f.write("-----")
-                f.write(full_sentence[1])
-                f.write("----")
-                f.write(colors_dict[df_utterance[agent_num]['agent_color'][1]])
-                f.write(" " + str(df_utterance[agent_num]['dist'][1]))
-                f.write(" " + str(iter))
-                f.write('\n')
+            log = get_sink(folder_dir + os.sep + "utterance_out_fb.csv", utterance_config.log_every)
+            if log.sampled(epoch):
+                log.write("-----" + full_sentence[1] + "----" + colors_dict[df_utterance[agent_num]['agent_color'][1]]
+                          + " " + str(df_utterance[agent_num]['dist'][1]) + " " + str(iter) + '\n')
     if mode == 'train_utter':
+            utter.checkpoints.step(utter.lm_model, utter.lm_steps, force=True)
+            utter.checkpoints.close()
             with open(training_config.save_model_file, 'wb') as f:
                 torch.save(utter.state_dict(), f)
+    close_all()
     print("Saved agent model weights at %s" % training_config.save_model_file)
 
 if __name__ == "__main__":